@@ -0,0 +1,99 @@
+"""Script for benchmarking the cost of extracting a masked segment from an image"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from utilities import *
+
+
+def parse_args():
+    """Function to parse script arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-in",
+        dest="INPUT_FILES",
+        default="sample/posters/*.jpg",
+        help="Path to images",
+    )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=4000,
+        help="Max dimension of a source image; image will be resized before processing",
+    )
+    parser.add_argument(
+        "-segments",
+        dest="SEGMENT_COUNT",
+        type=int,
+        default=100,
+        help="Number of segments to extract per image",
+    )
+    parser.add_argument(
+        "-size",
+        dest="SEGMENT_SIZE",
+        type=int,
+        default=200,
+        help="Size of each segment's bounding box in pixels",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def extract_segment_full_frame(image, mask, bbox):
+    """Extract a segment the way the writers used to: mask the whole frame, then crop"""
+    x, y, w, h = bbox
+    image_rgba = cv2.cvtColor(image, cv2.COLOR_RGB2BGRA)
+    masked_image = cv2.bitwise_and(image_rgba, image_rgba, mask=mask)
+    return masked_image[y : y + h, x : x + w]
+
+
+def main(a):
+    """Main function to compare the per-segment cost of full-frame and crop-first extraction"""
+
+    filenames = get_filenames(a.INPUT_FILES)
+    rng = np.random.default_rng(1)
+    size = a.SEGMENT_SIZE
+
+    for fn in filenames:
+        image = load_image(fn, a.MAX_IMAGE_DIMENSION)
+        if image is None:
+            continue
+        im_h, im_w, _ = image.shape
+
+        # Make a glyph-like elliptical mask in a random box for each segment
+        bboxes = []
+        for _ in range(a.SEGMENT_COUNT):
+            x = int(rng.integers(0, max(1, im_w - size)))
+            y = int(rng.integers(0, max(1, im_h - size)))
+            bboxes.append((x, y, min(size, im_w - x), min(size, im_h - y)))
+        full_masks = []
+        for x, y, w, h in bboxes:
+            mask = np.zeros((im_h, im_w), dtype=np.uint8)
+            cv2.ellipse(
+                mask, (x + w // 2, y + h // 2), (w // 2, h // 2), 0, 0, 360, 255, -1
+            )
+            full_masks.append(mask)
+
+        start_time = time.perf_counter()
+        for mask, bbox in zip(full_masks, bboxes):
+            extract_segment_full_frame(image, mask, bbox)
+        before = (time.perf_counter() - start_time) / len(bboxes)
+
+        start_time = time.perf_counter()
+        for mask, bbox in zip(full_masks, bboxes):
+            extract_segment(image, mask, bbox)
+        after = (time.perf_counter() - start_time) / len(bboxes)
+
+        print(
+            f"{fn} ({im_w}x{im_h}): {before * 1000:.3f}ms before, {after * 1000:.3f}ms after per segment ({before / after:.1f}x)"
+        )
+
+
+main(parse_args())
@@ -0,0 +1,100 @@
+"""Script for benchmarking the throughput of Mask R-CNN instance segmentation"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+
+import torch
+
+from benchmark_utilities import *
+from model_utilities import *
+from utilities import *
+
+
+def parse_args():
+    """Function to parse script arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-in", dest="INPUT_FILES", default="sample/faces/*.jpg", help="Path to images"
+    )
+    parser.add_argument(
+        "-count",
+        dest="IMAGE_COUNT",
+        type=int,
+        default=8,
+        help="Max number of images to segment",
+    )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=1333,
+        help="Max dimension to load the images at",
+    )
+    parser.add_argument(
+        "-threshold",
+        dest="SEGMENT_THRESHOLD",
+        type=float,
+        default=0.95,
+        help="Min detection score for keeping a segment",
+    )
+    parser.add_argument(
+        "-batch",
+        dest="BATCH_SIZE",
+        type=int,
+        default=4,
+        help="Number of images to run through the model at the same time",
+    )
+    parser.add_argument(
+        "-untrained",
+        dest="UNTRAINED",
+        action="store_true",
+        help="Use randomly initialized weights, e.g. to measure throughput without downloading the pretrained ones",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def segment_one_at_a_time(a, images):
+    """Segment images the way instance_segment_images used to: one at a time with autograd on, filtering by score afterwards"""
+    detector = get_detector(pretrained=not a.UNTRAINED)
+    for image in images:
+        tensor = torch.from_numpy(image).permute(2, 0, 1).float().div(255)
+        output = detector([tensor])[0]
+        masks = output["masks"][output["scores"] > a.SEGMENT_THRESHOLD]
+        masks = masks.squeeze(1) > 0.5
+
+
+def segment_in_batches(a, images):
+    """Segment images in batches in inference mode, dropping low scores before masks are pasted"""
+    detector = get_detector(a.SEGMENT_THRESHOLD, pretrained=not a.UNTRAINED)
+    for start in range(0, len(images), a.BATCH_SIZE):
+        detect_instances(detector, images[start : start + a.BATCH_SIZE])
+
+
+def main(a):
+    """Main function to compare Mask R-CNN throughput before and after"""
+
+    filenames = get_filenames(a.INPUT_FILES)[: a.IMAGE_COUNT]
+    images = [load_image(fn, a.MAX_IMAGE_DIMENSION) for fn in filenames]
+    images = [image for image in images if image is not None]
+    if len(images) == 0:
+        print(f"No images found: {a.INPUT_FILES}")
+        return
+
+    # Load the model once so the timings don't include reading the weights from disk the first time
+    get_detector(pretrained=not a.UNTRAINED)
+
+    print(f"Segmenting {len(images)} images at max dimension {a.MAX_IMAGE_DIMENSION}")
+    before_time, before_memory = measure_call(segment_one_at_a_time, a, images)
+    after_time, after_memory = measure_call(segment_in_batches, a, images)
+    print(
+        f"Before: {len(images) / before_time:.2f} images/s, peak memory +{before_memory:,.0f} MB"
+    )
+    print(
+        f"After: {len(images) / after_time:.2f} images/s, peak memory +{after_memory:,.0f} MB"
+    )
+
+
+main(parse_args())
@@ -0,0 +1,116 @@
+"""Script for benchmarking how fast the largest segment of a large mask is found"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+
+from benchmark_utilities import *
+from utilities import *
+
+
+def parse_args():
+    """Function to parse script arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-size",
+        dest="MASK_SIZE",
+        type=int,
+        default=4096,
+        help="Width and height of the synthetic masks",
+    )
+    parser.add_argument(
+        "-count",
+        dest="MASK_COUNT",
+        type=int,
+        default=10,
+        help="Number of synthetic masks",
+    )
+    parser.add_argument(
+        "-blobs",
+        dest="BLOB_COUNT",
+        type=int,
+        default=2000,
+        help="Number of small blobs to scatter around the large segment of each mask",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def get_largest_mask_segment_loop(mask_image):
+    """Find the largest segment the way get_largest_mask_segment used to: loop over the sizes and fill a full-frame float mask"""
+    nb_components, output, stats, centroids = cv2.connectedComponentsWithStats(
+        mask_image, connectivity=4
+    )
+    sizes = stats[:, -1]
+    max_label = 1
+    max_size = sizes[1]
+    for i in range(1, nb_components):
+        if sizes[i] > max_size:
+            max_label = i
+            max_size = sizes[i]
+    mask_with_largest_segment = np.zeros(output.shape)
+    mask_with_largest_segment[output == max_label] = 255
+
+    width = stats[max_label, cv2.CC_STAT_WIDTH]
+    height = stats[max_label, cv2.CC_STAT_HEIGHT]
+    x = stats[max_label, cv2.CC_STAT_LEFT]
+    y = stats[max_label, cv2.CC_STAT_TOP]
+
+    # remove_background cast the mask back to uint8 before using it
+    mask = mask_with_largest_segment.astype(np.uint8)
+    return {"mask": mask, "bbox": (x, y, width, height)}
+
+
+def make_masks(size, count, blob_count):
+    """Make masks with one large ellipse and many small blobs, like an inverted background mask"""
+    rng = np.random.default_rng(1)
+    masks = []
+    for _ in range(count):
+        mask = np.zeros((size, size), dtype=np.uint8)
+        cx, cy = rng.integers(size // 3, size * 2 // 3, size=2).tolist()
+        axes = tuple(rng.integers(size // 8, size // 4, size=2).tolist())
+        cv2.ellipse(mask, (cx, cy), axes, 0, 0, 360, 255, -1)
+        for x, y in rng.integers(0, size, size=(blob_count, 2)).tolist():
+            cv2.circle(mask, (x, y), int(rng.integers(1, 8)), 255, -1)
+        masks.append(mask)
+    return masks
+
+
+def run_all(fn, masks):
+    """Find the largest segment of every mask"""
+    for mask in masks:
+        fn(mask)
+
+
+def main(a):
+    """Main function to compare finding the largest segment before and after"""
+
+    masks = make_masks(a.MASK_SIZE, a.MASK_COUNT, a.BLOB_COUNT)
+    print(
+        f"Finding the largest segment of {a.MASK_COUNT} {a.MASK_SIZE}x{a.MASK_SIZE} masks"
+    )
+
+    before_time, before_memory = measure_call(
+        run_all, get_largest_mask_segment_loop, masks
+    )
+    after_time, after_memory = measure_call(run_all, get_largest_mask_segment, masks)
+    print(
+        f"Before: {before_time / a.MASK_COUNT * 1000:.1f}ms per mask, peak memory +{before_memory:,.0f} MB"
+    )
+    print(
+        f"After: {after_time / a.MASK_COUNT * 1000:.1f}ms per mask, peak memory +{after_memory:,.0f} MB"
+    )
+
+    # Both should find the same segment
+    for mask in masks:
+        before = get_largest_mask_segment_loop(mask)
+        after = get_largest_mask_segment(mask)
+        x, y, w, h = before["bbox"]
+        if tuple(before["bbox"]) != after["bbox"] or not np.array_equal(
+            before["mask"][y : y + h, x : x + w], after["mask"]
+        ):
+            print("Warning: segments do not match")
+
+
+main(parse_args())
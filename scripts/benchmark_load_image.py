@@ -0,0 +1,112 @@
+"""Script for benchmarking the time and memory it takes to load large images at the size they will be segmented at"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+
+from benchmark_utilities import *
+from utilities import *
+
+
+def parse_args():
+    """Function to parse script arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-in",
+        dest="INPUT_FILES",
+        default="sample/*/*.jpg",
+        help="Path to images",
+    )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=1024,
+        help="Max dimension to load the images at",
+    )
+    parser.add_argument(
+        "-large",
+        dest="LARGE_IMAGE_SIZE",
+        default="19000x10000",
+        help="Width x height of a synthetic JPEG to load on its own; the default is over Pillow's decompression bomb limit (about 179 MP), like the largest LoC and Met masters; leave blank to skip",
+    )
+    parser.add_argument(
+        "-out",
+        dest="OUTPUT_DIR",
+        default="output/benchmark/",
+        help="Directory to write the synthetic JPEG to",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def load_images_full(filenames, max_dimension):
+    """Load images the way load_image used to: decode at full size, then resize"""
+    for fn in filenames:
+        image = cv2.imread(fn)
+        if image is None:
+            continue
+        im_h, im_w, _ = image.shape
+        im_d = max(im_h, im_w)
+        if im_d > max_dimension:
+            scale = 1.0 * max_dimension / im_d
+            image = cv2.resize(
+                image, (round_int(im_w * scale), round_int(im_h * scale))
+            )
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def load_images_reduced(filenames, max_dimension):
+    """Load images with load_image, which decodes large JPEGs at a reduced scale"""
+    for fn in filenames:
+        load_image(fn, max_dimension)
+
+
+def make_jpeg(filename, width, height):
+    """Write a synthetic JPEG"""
+    rows = np.arange(height, dtype=np.uint32)[:, None]
+    cols = np.arange(width, dtype=np.uint32)[None, :]
+    gray = ((rows * 7 + cols * 13) % 256).astype(np.uint8)
+    cv2.imwrite(filename, cv2.merge([gray, gray[::-1], 255 - gray]))
+
+
+def compare(filenames, max_dimension):
+    """Print the time and peak memory it takes to load images before and after"""
+    before_time, before_memory = measure_call(
+        load_images_full, filenames, max_dimension
+    )
+    after_time, after_memory = measure_call(
+        load_images_reduced, filenames, max_dimension
+    )
+    print(f"Before: {before_time:.2f}s, peak memory +{before_memory:,.0f} MB")
+    print(f"After: {after_time:.2f}s, peak memory +{after_memory:,.0f} MB")
+
+
+def main(a):
+    """Main function to compare loading images before and after reduced decoding"""
+
+    filenames = get_filenames(a.INPUT_FILES)
+    if len(filenames) == 0:
+        print(f"No files found: {a.INPUT_FILES}")
+        return
+
+    print(f"Loading {len(filenames)} images at max dimension {a.MAX_IMAGE_DIMENSION}")
+    compare(filenames, a.MAX_IMAGE_DIMENSION)
+
+    if a.LARGE_IMAGE_SIZE == "":
+        return
+    width, height = [int(v) for v in a.LARGE_IMAGE_SIZE.split("x")]
+    make_directories(a.OUTPUT_DIR)
+    large_filename = f"{a.OUTPUT_DIR}synthetic-{width}x{height}.jpg"
+    if not os.path.isfile(large_filename):
+        measure_call(make_jpeg, large_filename, width, height)
+
+    # The header has to be readable for load_image to pick a reduced decode
+    print(
+        f"Loading a {width}x{height} JPEG; header size: {get_image_size(large_filename)}"
+    )
+    compare([large_filename], a.MAX_IMAGE_DIMENSION)
+
+
+main(parse_args())
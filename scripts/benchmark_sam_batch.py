@@ -0,0 +1,85 @@
+"""Script for benchmarking the SAM image encoder at different batch sizes"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import time
+
+from segment_anything import sam_model_registry
+import torch
+
+from model_utilities import *
+from utilities import *
+
+
+def parse_args():
+    """Function to parse script arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-in", dest="INPUT_FILES", default="sample/faces/*.jpg", help="Path to images"
+    )
+    parser.add_argument("-model", dest="MODEL", default="vit_h", help="Model used")
+    parser.add_argument(
+        "-checkpoint",
+        dest="MODEL_CHECKPOINT",
+        default="models/sam_vit_h_4b8939.pth",
+        help="Path to checkpoint file",
+    )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=4000,
+        help="Max dimension of a source image; image will be resized before processing",
+    )
+    parser.add_argument(
+        "-batches",
+        dest="BATCH_SIZES",
+        default="1,2,4,8",
+        help="Comma separated list of batch sizes to benchmark",
+    )
+    parser.add_argument(
+        "-count",
+        dest="IMAGE_COUNT",
+        type=int,
+        default=8,
+        help="Number of images to encode for each batch size",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main(a):
+    """Main function to benchmark image encoder throughput"""
+
+    os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+    filenames = get_filenames(a.INPUT_FILES)[: a.IMAGE_COUNT]
+    images = [load_image(fn, a.MAX_IMAGE_DIMENSION) for fn in filenames]
+    images = [image for image in images if image is not None]
+    image_count = len(images)
+    print(f"{image_count} images loaded.")
+
+    sam = sam_model_registry[a.MODEL](checkpoint=a.MODEL_CHECKPOINT)
+    if torch.cuda.is_available():
+        print("CUDA is available")
+        sam.to(device="cuda")
+    print(f"Torch threads: {torch.get_num_threads()}")
+
+    # Warm up
+    encode_images(sam, images[:1])
+
+    batch_sizes = [int(size) for size in a.BATCH_SIZES.split(",")]
+    for batch_size in batch_sizes:
+        start_time = time.perf_counter()
+        for start in range(0, image_count, batch_size):
+            encode_images(sam, images[start : start + batch_size])
+        elapsed = time.perf_counter() - start_time
+        print(
+            f"Batch size {batch_size}: {image_count / elapsed:.3f} images/sec ({elapsed:.2f}s total)"
+        )
+
+
+main(parse_args())
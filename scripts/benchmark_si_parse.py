@@ -0,0 +1,129 @@
+"""Script for benchmarking how fast Smithsonian open access data files are parsed into rows"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import time
+
+from utilities import *
+
+
+def parse_args():
+    """Function to parse script arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-in",
+        dest="INPUT_FILES",
+        default="data/si-sample.txt",
+        help="Path to line-delimited json data files; defaults to a small sample shard, or use ones cached by get_si_data.py, e.g. cache/si-chndm/*.txt",
+    )
+    parser.add_argument(
+        "-rows",
+        dest="MAX_ROWS",
+        type=int,
+        default=20000,
+        help="Max number of rows to read from each file",
+    )
+    parser.add_argument(
+        "-repeat",
+        dest="REPEAT",
+        type=int,
+        default=50,
+        help="Number of times to parse the rows of each file, so small files give a steady rate",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def parse_si_json_nested(json_data):
+    """Convert a JSON data item to flat row the way get_si_data used to: walking down from the root for every field"""
+    row = {}
+
+    descriptive = get_nested_value(
+        json_data, ["content", "descriptiveNonRepeating"], {}
+    )
+    structured = get_nested_value(json_data, ["content", "indexedStructured"], {})
+    freetext = get_nested_value(json_data, ["content", "freetext"], {})
+
+    row["id"] = get_nested_value(descriptive, "record_ID")
+    row["title"] = get_nested_value(json_data, "title", "Untitled")
+    row["unit_code"] = get_nested_value(json_data, "unitCode")
+    row["record_link"] = get_nested_value(descriptive, "record_link")
+    row["access"] = get_nested_value(descriptive, ["metadata_usage", "access"])
+    row["data_source"] = get_nested_value(descriptive, "data_source")
+    row["date"] = get_nested_value(structured, ["date", 0])
+    row["name"] = get_nested_value(structured, ["name", 0])
+    row["object_type"] = get_nested_value(structured, ["object_type", 0])
+    row["object_type_2"] = get_nested_value(structured, ["object_type", 1])
+    row["object_type_3"] = get_nested_value(structured, ["object_type", 2])
+    row["topic"] = get_nested_value(structured, ["topic", 0])
+    row["place"] = get_nested_value(structured, ["place", 0])
+
+    sets = get_nested_value(freetext, "setName", [])
+    row["group"] = sets[-1]["content"] if len(sets) > 0 else ""
+
+    notes = get_nested_value(freetext, "notes", [])
+    row["description"] = get_where(notes, "content", ("label", "Description"))
+
+    physical_descriptions = get_nested_value(freetext, "physicalDescription", [])
+    row["medium"] = get_where(physical_descriptions, "content", ("label", "Medium"))
+    row["dimensions"] = get_where(
+        physical_descriptions, "content", ("label", "Dimensions")
+    )
+
+    resources = get_nested_value(
+        descriptive, ["online_media", "media", 0, "resources"], []
+    )
+    resources = [r for r in resources if "height" in r]
+    if len(resources) > 0:
+        resources = sorted(resources, key=lambda r: -r["height"])
+        largest_resource = resources[0]
+        row["image"] = largest_resource["url"]
+        row["image_width"] = largest_resource["width"]
+        row["image_height"] = largest_resource["height"]
+
+    return row
+
+
+def time_parse(lines, loads, parse_fn, repeat=1):
+    """Return the rows parsed from lines and the number of rows per second"""
+    start_time = time.perf_counter()
+    for _ in range(max(1, repeat)):
+        rows = [parse_fn(loads(line)) for line in lines]
+    elapsed = time.perf_counter() - start_time
+    return rows, len(rows) * max(1, repeat) / max(elapsed, 1e-9)
+
+
+def main(a):
+    """Main function to compare the speed of parsing data files before and after"""
+
+    filenames = get_filenames(a.INPUT_FILES)
+    if len(filenames) == 0:
+        print(f"No files found: {a.INPUT_FILES}")
+        return
+
+    for fn in filenames:
+        lines = []
+        with open(fn, "rb") as f:
+            for line in f:
+                if line.strip():
+                    lines.append(line)
+                if len(lines) >= a.MAX_ROWS:
+                    break
+
+        before_rows, before = time_parse(
+            lines, json.loads, parse_si_json_nested, a.REPEAT
+        )
+        after_rows, after = time_parse(lines, json.loads, parse_si_json, a.REPEAT)
+        if before_rows != after_rows:
+            print(f"Warning: rows parsed from {fn} do not match")
+        message = f"{fn} ({len(lines):,} rows): {before:,.0f} rows/s before, {after:,.0f} rows/s after"
+        if orjson is not None:
+            _, after_orjson = time_parse(lines, orjson.loads, parse_si_json, a.REPEAT)
+            message += f", {after_orjson:,.0f} rows/s after with orjson"
+        print(message)
+
+
+main(parse_args())
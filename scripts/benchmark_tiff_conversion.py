@@ -0,0 +1,89 @@
+"""Script for benchmarking the time and memory it takes to convert a large 16-bit TIFF to an 8-bit JPEG"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+
+import numpy as np
+import PIL
+
+from benchmark_utilities import *
+from utilities import *
+
+
+def parse_args():
+    """Function to parse script arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-size",
+        dest="IMAGE_SIZE",
+        type=int,
+        default=12000,
+        help="Width and height of the synthetic 16-bit TIFF",
+    )
+    parser.add_argument(
+        "-out",
+        dest="OUTPUT_DIR",
+        default="output/benchmark/",
+        help="Directory to write the synthetic TIFF and converted JPEGs to",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def convert_in_memory(src_filename, filename):
+    """Convert a 16-bit TIFF the way get_loc_images used to: decode it all and normalize it as floats"""
+    image = Image.open(src_filename)
+    array = np.array(image)
+    normalized = (
+        (array.astype(np.uint16) - array.min()) * 255.0 / (array.max() - array.min())
+    )
+    image = Image.fromarray(normalized.astype(np.uint8))
+    image.save(filename)
+
+
+def convert_in_strips(src_filename, filename):
+    """Convert a 16-bit TIFF a few rows at a time"""
+    with Image.open(src_filename) as image:
+        save_16bit_image_as_8bit(image, filename)
+
+
+def make_tiff(filename, size):
+    """Write a synthetic 16-bit grayscale TIFF"""
+    rows = np.arange(size, dtype=np.uint32)[:, None]
+    cols = np.arange(size, dtype=np.uint32)[None, :]
+    array = ((rows * 7 + cols * 13) % 50000 + 1000).astype(np.uint16)
+    Image.fromarray(array).save(filename)
+
+
+def main(a):
+    """Main function to compare converting a large 16-bit TIFF in memory and in strips"""
+
+    make_directories(a.OUTPUT_DIR)
+    PIL.Image.MAX_IMAGE_PIXELS = None
+
+    src_filename = f"{a.OUTPUT_DIR}synthetic-16bit.tif"
+    measure_call(make_tiff, src_filename, a.IMAGE_SIZE)
+    print(
+        f"Converting a {a.IMAGE_SIZE}x{a.IMAGE_SIZE} 16-bit TIFF ({os.path.getsize(src_filename) / 1024 / 1024:,.0f} MB)"
+    )
+
+    before_filename = f"{a.OUTPUT_DIR}synthetic-before.jpg"
+    after_filename = f"{a.OUTPUT_DIR}synthetic-after.jpg"
+    before_time, before_memory = measure_call(
+        convert_in_memory, src_filename, before_filename
+    )
+    after_time, after_memory = measure_call(
+        convert_in_strips, src_filename, after_filename
+    )
+    print(f"Before: {before_time:.2f}s, peak memory +{before_memory:,.0f} MB")
+    print(f"After: {after_time:.2f}s, peak memory +{after_memory:,.0f} MB")
+
+    # Both should produce the same pixels
+    before = np.asarray(Image.open(before_filename))
+    after = np.asarray(Image.open(after_filename))
+    print(f"Max pixel difference: {np.abs(before.astype(int) - after).max()}")
+
+
+main(parse_args())
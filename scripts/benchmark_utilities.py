@@ -0,0 +1,25 @@
+"""Utility functions to support the benchmark scripts"""
+
+import multiprocessing
+import resource
+import time
+
+
+def measure_call(fn, *args):
+    """Run a function in a forked process and return (seconds, peak memory growth in MB), so each measurement starts from the same memory baseline"""
+
+    def run_measured(results):
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start_time = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start_time
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results.put((elapsed, (peak_rss - start_rss) / 1024))
+
+    mp_context = multiprocessing.get_context("fork")
+    results = mp_context.Queue()
+    process = mp_context.Process(target=run_measured, args=(results,))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
@@ -0,0 +1,118 @@
+"""Utility functions to support the scripts that read tabular collection data"""
+
+import os
+import re
+
+import pandas as pd
+
+# Columnar caching is optional; without pyarrow the CSV is read directly
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Key in the Parquet metadata that records which version of the CSV the cache was made from
+CACHE_SOURCE_KEY = b"source_csv"
+
+
+def get_csv_cache(filename, create=True):
+    """Return the filename of a CSV's Parquet cache, creating or refreshing it if the CSV changed; None if it is stale and create is False"""
+    cache_filename = f"{os.path.splitext(filename)[0]}.parquet"
+    stat = os.stat(filename)
+    source = f"{stat.st_size}:{stat.st_mtime_ns}".encode()
+
+    if os.path.isfile(cache_filename):
+        metadata = pq.read_schema(cache_filename).metadata or {}
+        if metadata.get(CACHE_SOURCE_KEY) == source:
+            return cache_filename
+
+    if not create:
+        return None
+
+    print(f"Caching {filename} as {cache_filename}...")
+    df = pd.read_csv(filename, low_memory=False)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), CACHE_SOURCE_KEY: source}
+    )
+    temp_filename = f"{cache_filename}.part"
+    pq.write_table(table, temp_filename)
+    os.replace(temp_filename, cache_filename)
+    return cache_filename
+
+
+def get_query_columns(query_string, column_names):
+    """Return the column names that a Pandas query string (or list of them) refers to"""
+    if isinstance(query_string, list):
+        query_string = "\n".join(query_string)
+    if query_string == "":
+        return []
+    # Quoted strings could contain text that looks like a column name
+    unquoted = re.sub(r"\"[^\"]*\"|'[^']*'", "", query_string)
+    columns = []
+    for column_name in column_names:
+        if f"`{column_name}`" in query_string or re.search(
+            rf"(?<![\w`]){re.escape(column_name)}(?![\w`])", unquoted
+        ):
+            columns.append(column_name)
+    return columns
+
+
+def iter_table_chunks(filename, columns, query_string="", chunk_size=100000):
+    """Yield (row count, filtered DataFrame) for each chunk of a CSV or Parquet file, reading only the given columns plus any the query uses"""
+    parquet_filename = None
+    if pa is not None:
+        if filename.lower().endswith(".parquet"):
+            parquet_filename = filename
+        else:
+            # Use the columnar cache if it is current, but don't build it since that reads the whole file into memory
+            parquet_filename = get_csv_cache(filename, create=False)
+
+    if parquet_filename is not None:
+        parquet_file = pq.ParquetFile(parquet_filename)
+        column_names = parquet_file.schema_arrow.names
+    else:
+        column_names = list(pd.read_csv(filename, nrows=0).columns)
+    query_columns = get_query_columns(query_string, column_names)
+    needed = set(columns) | set(query_columns)
+    columns = [name for name in column_names if name in needed]
+
+    if parquet_filename is not None:
+        chunks = (
+            batch.to_pandas()
+            for batch in parquet_file.iter_batches(
+                batch_size=chunk_size, columns=columns
+            )
+        )
+    else:
+        # Read the columns that are only counted as text so their values are the same type in every chunk
+        dtype = {name: str for name in columns if name not in query_columns}
+        chunks = pd.read_csv(
+            filename, usecols=columns, dtype=dtype, chunksize=chunk_size
+        )
+
+    for chunk in chunks:
+        row_count = chunk.shape[0]
+        if query_string != "":
+            chunk = chunk.query(query_string)
+        yield row_count, chunk
+
+
+def read_csv_cached(filename, columns=None, query_string=""):
+    """Read a CSV through a typed Parquet cache, loading only the given columns plus any the query (or queries) use"""
+    if pa is None:
+        return pd.read_csv(filename, low_memory=False)
+
+    try:
+        cache_filename = get_csv_cache(filename)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as error:
+        print(f"Could not cache {filename}; reading the CSV: {error}")
+        return pd.read_csv(filename, low_memory=False)
+
+    column_names = pq.read_schema(cache_filename).names
+    if columns is not None:
+        needed = set(columns) | set(get_query_columns(query_string, column_names))
+        columns = [name for name in column_names if name in needed]
+
+    return pd.read_parquet(cache_filename, columns=columns)
@@ -4,6 +4,7 @@
 
 import argparse
 import os
+import string
 import struct
 import time
 
@@ -41,16 +42,167 @@ def parse_args():
         default="output/si-cultery/si-{id}.jpg",
         help="Output data file",
     )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=0,
+        help="Request images no larger than this on their longest side from servers that can resize them (IIIF, ids.si.edu); use the -maxd of the scripts that will process them; 0 for full size",
+    )
+    parser.add_argument(
+        "-workers",
+        dest="WORKERS",
+        type=int,
+        default=4,
+        help="Number of images to download at the same time",
+    )
+    parser.add_argument(
+        "-perhost",
+        dest="MAX_PER_HOST",
+        type=int,
+        default=4,
+        help="Max number of simultaneous requests to any one host",
+    )
+    parser.add_argument(
+        "-retries",
+        dest="MAX_RETRIES",
+        type=int,
+        default=5,
+        help="Max number of times to retry a throttled or failed request",
+    )
     parser.add_argument(
         "-probe",
         dest="PROBE",
         action="store_true",
-        help="Only output info and do not perform downloads",
+        help="Only output info, including how many items and bytes are left to download, and do not perform downloads",
+    )
+    parser.add_argument(
+        "-retry-failed",
+        dest="RETRY_FAILED",
+        action="store_true",
+        help="Retry images that failed in a previous run",
     )
     args = parser.parse_args()
     return args
 
 
+def process_item(job):
+    """Download an image, converting it if the source and destination formats differ"""
+    image_url, image_filename, convert = job
+    result = {"filename": image_filename, "saved": False, "message": ""}
+
+    # Source and destination file extension is the same, just download
+    if not convert:
+        download(image_url, image_filename, verbose=False)
+
+    # Source and destination file extension is different, download and convert
+    else:
+        image = download_and_read_image(image_url)
+        try:
+            # The download failed if there is no image
+            if image is not False:
+                image.save(image_filename)
+        except OSError:
+            result["message"] = f"Invalid image: OSError with {image_url}"
+        except KeyError:
+            result["message"] = f"Invalid image: KeyError with {image_url}"
+
+    # If no image was downloaded, assume an error
+    if os.path.isfile(image_filename):
+        result["saved"] = True
+        result["message"] = f"Saved {image_filename}"
+
+    return result
+
+
+def format_filenames(pattern, items):
+    """Fill in a filename pattern like "output/si-{id}.jpg" for every row, a column at a time"""
+    fields = list(string.Formatter().parse(pattern))
+
+    # Patterns with format specs or conversions are filled in row by row
+    if any(spec or conversion for _, _, spec, conversion in fields):
+        return pd.Series(
+            [pattern.format(**item) for item in items.to_dict("records")],
+            index=items.index,
+        )
+
+    filenames = pd.Series("", index=items.index, dtype=object)
+    for literal, field, _, _ in fields:
+        filenames = filenames + literal
+        if field is not None:
+            filenames = filenames + items[field].map(str)
+    return filenames
+
+
+def get_extensions(paths):
+    """Return the lowercase file extension of every path or URL in a column, ignoring any #fragment"""
+    basenames = paths.str.replace(r"^.*/", "", regex=True)
+    extensions = basenames.str.extract(r"[^.](\.[^.]*)$", expand=False).fillna("")
+    return extensions.str.split("#", n=1).str[0].str.lower()
+
+
+def plan_jobs(a, items, manifest):
+    """Return the (image URL, filename, convert?) job and position of each item that has not been downloaded yet"""
+    image_urls = items[a.IMAGE_COLUMN].astype(str)
+    if a.MAX_IMAGE_DIMENSION > 0:
+        image_urls = image_urls.map(
+            lambda url: get_sized_image_url(url, a.MAX_IMAGE_DIMENSION)
+        )
+    image_filenames = format_filenames(a.OUTPUT_FILE, items)
+    convert = get_extensions(image_urls) != get_extensions(image_filenames)
+
+    # List each output directory once instead of checking every file
+    existing_filenames = set()
+    for dirname in image_filenames.map(os.path.dirname).unique():
+        if os.path.isdir(dirname or "."):
+            existing_filenames.update(
+                os.path.normpath(os.path.join(dirname, entry))
+                for entry in os.listdir(dirname or ".")
+            )
+
+    jobs = []
+    job_indices = []
+    for i, (image_url, image_filename, item_convert) in enumerate(
+        zip(image_urls, image_filenames, convert)
+    ):
+        if manifest.is_done(image_filename, a.RETRY_FAILED):
+            continue
+
+        # Outputs from before there was a manifest
+        if (
+            image_filename not in manifest
+            and os.path.normpath(image_filename) in existing_filenames
+        ):
+            manifest.record(image_filename, "processed", [image_filename], commit=False)
+            continue
+
+        jobs.append((image_url, image_filename, item_convert))
+        job_indices.append(i)
+    manifest.commit()
+
+    return jobs, job_indices
+
+
+def probe_jobs(a, jobs):
+    """Report how many items and bytes are left to download"""
+    print(f"{len(jobs):,} items left to download")
+    if len(jobs) == 0:
+        return
+
+    total_bytes = 0
+    unknown = 0
+    sizes = run_jobs(jobs, lambda job: get_content_length(job[0]), a.WORKERS)
+    for size in sizes:
+        if size is None:
+            unknown += 1
+        else:
+            total_bytes += size
+    message = f"{total_bytes / 1024 / 1024:,.1f} MB left to download"
+    if unknown > 0:
+        message += f" ({unknown:,} items of unknown size)"
+    print(message)
+
+
 def main(a):
     """Main function retrieve images"""
 
@@ -70,63 +222,51 @@ def main(a):
     total_items = items.shape[0]
     print(f"{total_items:,} items after filtering out items with no image")
 
-    # Probe
-    if a.PROBE:
-        return
-
     # Make directories
-    make_directories(a.OUTPUT_FILE)
+    if not a.PROBE:
+        make_directories(a.OUTPUT_FILE)
+
+    set_max_requests_per_host(a.MAX_PER_HOST)
+    configure_http_session(pool_size=a.MAX_PER_HOST, max_retries=a.MAX_RETRIES)
 
     # Reset the index
     items = items.reset_index()
 
-    # Iterate through items
-    errors = 0
-    for i, item in items.iterrows():
-        image_filename = a.OUTPUT_FILE.format(**item)
-
-        if os.path.isfile(image_filename):
-            continue
-
-        # Download and save the image
-        image_url = item[a.IMAGE_COLUMN]
-
-        # Get the file extensions of the source and destination
-        src_fn, src_ext = os.path.splitext(image_url)
-        dest_fn, dest_ext = os.path.splitext(image_filename)
+    # Queue up items that have not been downloaded yet; probing only reads the manifest
+    manifest = RunManifest(
+        os.path.join(os.path.dirname(a.OUTPUT_FILE), "manifest.db"),
+        {"IMAGE_COLUMN": a.IMAGE_COLUMN},
+        read_only=a.PROBE,
+    )
+    jobs, job_indices = plan_jobs(a, items, manifest)
 
-        # Check for hash
-        if "#" in src_ext:
-            src_ext, _ = tuple(src_ext.split("#", 1))
+    # Probe
+    if a.PROBE:
+        probe_jobs(a, jobs)
+        manifest.close()
+        return
 
-        # print(src_ext, dest_ext)
-        # break
+    # Download images in parallel, reporting progress in order
+    errors = 0
+    for i, result in zip(job_indices, run_jobs(jobs, process_item, a.WORKERS)):
+        if result["saved"]:
+            manifest.record(result["filename"], "processed", [result["filename"]])
+            print(
+                f"{i+1} of {total_items} ({round(100.0*i/total_items,2)}%) {result['message']}"
+            )
+            continue
 
-        # Source and destination file extension is the same, just download
-        if src_ext.lower() == dest_ext.lower():
-            download(image_url, image_filename, verbose=False)
+        errors += 1
+        manifest.record(result["filename"], "failed", reason=result["message"])
+        if result["message"] != "":
+            print(result["message"])
 
-        # Source and destination file extension is different, download and convert
-        else:
-            image = download_and_read_image(image_url)
-            try:
-                image.save(image_filename)
-            except OSError:
-                print(f"Invalid image: OSError with {image_url}")
-            except KeyError:
-                print(f"Invalid image: KeyError with {image_url}")
-
-        # If no image was downloaded, assume an error
-        if not os.path.isfile(image_filename):
-            errors += 1
-            continue
+    manifest.close()
 
+    if errors > 0:
         print(
-            f"{i+1} of {total_items} ({round(100.0*i/total_items,2)}%) Saved {image_filename}"
+            f"Completed with {errors} errors. Re-run with -retry-failed to retry failed image downloads"
         )
-
-    if errors > 0:
-        print(f"Completed with {errors} errors. Re-run to retry failed image downloads")
     else:
         print("Finished with no errors")
 
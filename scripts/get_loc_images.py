@@ -4,7 +4,6 @@
 
 import argparse
 import os
-import time
 
 import numpy as np
 import pandas as pd
@@ -47,6 +46,40 @@ def parse_args():
         action="store_true",
         help="Clear the cache before processing?",
     )
+    parser.add_argument(
+        "-retry-failed",
+        dest="RETRY_FAILED",
+        action="store_true",
+        help="Retry items that failed in a previous run",
+    )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=0,
+        help="Download the smallest image resource at least this large on its longest side, resized by the server when it can (IIIF); use the -maxd of the scripts that will process them; 0 for the largest resource",
+    )
+    parser.add_argument(
+        "-workers",
+        dest="WORKERS",
+        type=int,
+        default=4,
+        help="Number of items to request and download at the same time",
+    )
+    parser.add_argument(
+        "-perhost",
+        dest="MAX_PER_HOST",
+        type=int,
+        default=4,
+        help="Max number of simultaneous requests to any one host",
+    )
+    parser.add_argument(
+        "-retries",
+        dest="MAX_RETRIES",
+        type=int,
+        default=5,
+        help="Max number of times to retry a throttled or failed request",
+    )
     parser.add_argument(
         "-debug",
         dest="DEBUG",
@@ -57,6 +90,173 @@ def parse_args():
     return args
 
 
+def get_item_data(api_url, result):
+    """Request an item from the API and return its image resources, largest first"""
+    response = json_request(api_url)
+    if "error" in response:
+        result["error"] = True
+        result["message"] = (
+            f"{response['error']} error when requesting {api_url}. Skipping."
+        )
+        return None
+
+    resources = []
+
+    # This is a page within a multi-page document
+    if "page" in response:
+        resources = response["page"]
+
+    # Retrieve resource list from API response
+    else:
+        resources = get_nested_value(response, ["resources", 0, "files", 0], [])
+
+    if not isinstance(resources, list) or len(resources) == 0:
+        result["message"] = f"No resources found for {api_url}"
+        return None
+
+    all_resources = resources[:]
+
+    # Filter out non-images
+    resources = [
+        r
+        for r in all_resources
+        if "mimetype" in r
+        and r["mimetype"] in ["image/jpg", "image/jpeg", "image/tiff"]
+        and "size" in r
+        and "url" in r
+    ]
+
+    # Sort by size
+    resources = sorted(resources, key=lambda r: -r["size"])
+
+    # use height if size is not available
+    if len(resources) == 0:
+        resources = [
+            r
+            for r in all_resources
+            if "mimetype" in r
+            and r["mimetype"] in ["image/jpg", "image/jpeg", "image/tiff"]
+            and "height" in r
+            and "url" in r
+        ]
+
+        # Sort by size
+        resources = sorted(resources, key=lambda r: -r["height"])
+
+    if len(resources) == 0:
+        result["message"] = f"No image resources for {api_url}"
+        return None
+
+    # Keep all of them so the size to download can be chosen later
+    fields = ["url", "mimetype", "size", "width", "height"]
+    resources = [{k: r[k] for k in fields if k in r} for r in resources]
+    return {"resource_url": resources[0]["url"], "resources": resources}
+
+
+def get_resource_url(item_data, max_dimension=0):
+    """Return the URL of the smallest image resource that is at least max_dimension on its longest side, or the largest one"""
+    resources = item_data.get("resources", [])
+    if max_dimension <= 0 or len(resources) == 0:
+        return item_data["resource_url"]
+
+    large_enough = [
+        r
+        for r in resources
+        if "width" in r
+        and "height" in r
+        and max(r["width"], r["height"]) >= max_dimension
+    ]
+    if len(large_enough) == 0:
+        return item_data["resource_url"]
+
+    # IIIF resources can be resized by the server to exactly the size needed, so prefer those
+    sized_resources = [
+        (
+            get_sized_image_url(r["url"], max_dimension, r["width"], r["height"]),
+            r,
+        )
+        for r in large_enough
+    ]
+    url, _ = min(
+        sized_resources,
+        key=lambda item: (
+            item[0] == item[1]["url"],
+            item[1]["width"] * item[1]["height"],
+            item[1].get("size", 0),
+        ),
+    )
+    return url
+
+
+def process_item(a, job):
+    """Request an item's data if it is not cached, then download and save its image"""
+    id, url, item_data = job
+    image_filename = f"{a.OUTPUT_DIR}loc-{id}.jpg"
+    result = {
+        "id": id,
+        "filename": image_filename,
+        "item_data": None,
+        "error": False,
+        "saved": False,
+        "message": "",
+    }
+
+    if item_data is None:
+        # Request data from API
+        api_url = f"{url}&fo=json" if "?" in url else f"{url}?fo=json"
+        item_data = get_item_data(api_url, result)
+        if item_data is None:
+            return result
+        result["item_data"] = item_data
+
+    if "resource_url" not in item_data:
+        return result
+
+    # Download and save the image
+    image_url = get_resource_url(item_data, a.MAX_IMAGE_DIMENSION)
+
+    # Get the file extensions of the source and destination
+    src_fn, src_ext = os.path.splitext(image_url)
+    dest_fn, dest_ext = os.path.splitext(image_filename)
+
+    # Check for hash
+    if "#" in src_ext:
+        src_ext, _ = tuple(src_ext.split("#", 1))
+
+    # Source and destination file extension is the same, just download
+    if src_ext.lower() == dest_ext.lower():
+        download(image_url, image_filename, verbose=False)
+
+    # Source and destination file extension is different, download and convert
+    else:
+        # Download to disk first so large TIFFs can be converted without decoding them into memory
+        src_filename = f"{dest_fn}{src_ext}"
+        download(image_url, src_filename, verbose=False)
+        try:
+            if os.path.isfile(src_filename):
+                with Image.open(src_filename) as image:
+                    # Check for 16-bit images; convert to 8-bit
+                    if image.format == "TIFF" and image.mode in ["I;16", "I;16B"]:
+                        save_16bit_image_as_8bit(image, image_filename)
+                    else:
+                        image.save(image_filename)
+        except OSError as e:
+            result["message"] = f"OSError: {e} with {image_url} in {url}"
+        except KeyError as e:
+            result["message"] = f"KeyError: {e} with {image_url} in {url}"
+        finally:
+            if os.path.isfile(src_filename):
+                os.remove(src_filename)
+
+    if not os.path.isfile(image_filename):
+        result["error"] = True
+        return result
+
+    result["saved"] = True
+    result["message"] = f"Saved {image_filename}"
+    return result
+
+
 def main(a):
     """Main function retrieve open access Library of Congress images"""
 
@@ -65,6 +265,9 @@ def main(a):
     if a.CLEAN:
         empty_directory(a.CACHE_DIRECTORY)
 
+    set_max_requests_per_host(a.MAX_PER_HOST)
+    configure_http_session(pool_size=a.MAX_PER_HOST, max_retries=a.MAX_RETRIES)
+
     # Trust all large images
     PIL.Image.MAX_IMAGE_PIXELS = None
 
@@ -82,130 +285,59 @@ def main(a):
         # Reset the index
         items = items.reset_index()
 
-    # Iterate through items
-    item_cache = load_cache_file(f"{a.CACHE_DIRECTORY}item_cache.p", {})
-    errors = 0
+    # Queue up items that have not been downloaded yet
+    item_cache = load_cache_file(f"{a.CACHE_DIRECTORY}item_cache.db", {})
+    manifest = RunManifest(f"{a.OUTPUT_DIR}manifest.db")
+    jobs = []
+    job_indices = []
     for i, item in items.iterrows():
         id = str(item["id"])
         url = str(item["url"])
 
         image_filename = f"{a.OUTPUT_DIR}loc-{id}.jpg"
 
-        if os.path.isfile(image_filename):
+        if manifest.is_done(id, a.RETRY_FAILED, image_filename, commit=False):
             continue
 
         # Check to see if item data is cached
         item_data = item_cache[id] if id in item_cache else None
-        if item_data is None:
-            # Request data from API
-            api_url = f"{url}&fo=json" if "?" in url else f"{url}?fo=json"
-            response = json_request(api_url)
-            if "error" in response:
-                print(f"{response['error']} error when requesting {api_url}. Skipping.")
-                errors += 1
-                time.sleep(1)
-                continue
-
-            resources = []
-
-            # This is a page within a multi-page document
-            if "page" in response:
-                resources = response["page"]
-
-            # Retrieve resource list from API response
-            else:
-                resources = get_nested_value(response, ["resources", 0, "files", 0], [])
-
-            if not isinstance(resources, list) or len(resources) == 0:
-                print(f"No resources found for {api_url}")
-                continue
-
-            all_resources = resources[:]
-
-            # Filter out non-images
-            resources = [
-                r
-                for r in all_resources
-                if "mimetype" in r
-                and r["mimetype"] in ["image/jpg", "image/jpeg", "image/tiff"]
-                and "size" in r
-                and "url" in r
-            ]
-
-            # Sort by size
-            resources = sorted(resources, key=lambda r: -r["size"])
-
-            # use height if size is not available
-            if len(resources) == 0:
-                resources = [
-                    r
-                    for r in all_resources
-                    if "mimetype" in r
-                    and r["mimetype"] in ["image/jpg", "image/jpeg", "image/tiff"]
-                    and "height" in r
-                    and "url" in r
-                ]
-
-                # Sort by size
-                resources = sorted(resources, key=lambda r: -r["height"])
-
-            if len(resources) == 0:
-                print(f"No image resources for {api_url}")
-                continue
-
-            largest_resource = resources[0]
-            item_data = {"resource_url": largest_resource["url"]}
-
-            # Save response to cache
-            item_cache[id] = item_data
-            save_cache_file(f"{a.CACHE_DIRECTORY}item_cache.p", item_cache)
-
-        # Download and save the image
-        if "resource_url" in item_data:
-            image_url = item_data["resource_url"]
-
-            # Get the file extensions of the source and destination
-            src_fn, src_ext = os.path.splitext(image_url)
-            dest_fn, dest_ext = os.path.splitext(image_filename)
-
-            # Check for hash
-            if "#" in src_ext:
-                src_ext, _ = tuple(src_ext.split("#", 1))
-
-            # Source and destination file extension is the same, just download
-            if src_ext.lower() == dest_ext.lower():
-                download(image_url, image_filename, verbose=False)
-
-            # Source and destination file extension is different, download and convert
-            else:
-                image = download_and_read_image(image_url)
-                try:
-                    # Check for 16-bit images; convert to 8-bit
-                    if image.format == "TIFF" and image.mode == "I;16":
-                        array = np.array(image)
-                        normalized = (
-                            (array.astype(np.uint16) - array.min())
-                            * 255.0
-                            / (array.max() - array.min())
-                        )
-                        image = Image.fromarray(normalized.astype(np.uint8))
-                    image.save(image_filename)
-                except OSError as e:
-                    print(f"OSError: {e} with {image_url} in {url}")
-                except KeyError as e:
-                    print(f"KeyError: {e} with {image_url} in {url}")
-
-            if not os.path.isfile(image_filename):
-                errors += 1
-                time.sleep(1)
-                continue
+        jobs.append((id, url, item_data))
+        job_indices.append(i)
+    manifest.commit()
 
+    # Request and download items in parallel, reporting progress in order
+    errors = 0
+    results = run_jobs(jobs, lambda job: process_item(a, job), a.WORKERS)
+    for i, result in zip(job_indices, results):
+        # Save response to cache
+        if result["item_data"] is not None:
+            item_cache[result["id"]] = result["item_data"]
+            save_cache_file(f"{a.CACHE_DIRECTORY}item_cache.db", item_cache)
+
+        if result["saved"]:
+            manifest.record(result["id"], "processed", [result["filename"]])
             print(
-                f"{i+1} of {total_items} ({round(100.0*i/total_items,2)}%) Saved {image_filename}"
+                f"{i+1} of {total_items} ({round(100.0*i/total_items,2)}%) {result['message']}"
             )
+            continue
+
+        if result["error"]:
+            errors += 1
+            manifest.record(result["id"], "failed", reason=result["message"])
+        else:
+            manifest.record(
+                result["id"], "skipped", reason=result["message"] or "No image"
+            )
+        if result["message"] != "":
+            print(result["message"])
+
+    item_cache.close()
+    manifest.close()
 
     if errors > 0:
-        print(f"Completed with {errors} errors. Re-run to retry failed image downloads")
+        print(
+            f"Completed with {errors} errors. Re-run with -retry-failed to retry failed image downloads"
+        )
     else:
         print("Finished with no errors")
 
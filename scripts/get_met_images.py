@@ -4,12 +4,13 @@
 
 import argparse
 import os
+import shutil
 import struct
-import time
 
 import pandas as pd
 import piexif
 
+from data_utilities import *
 from utilities import *
 
 
@@ -41,12 +42,45 @@ def parse_args():
         default="output/met-sculptures/",
         help="Output data file",
     )
+    parser.add_argument(
+        "-queries",
+        dest="QUERIES_FILE",
+        default="",
+        help="File with one `query -> output directory` pair per line to download several queries at once; overrides -query and -out",
+    )
     parser.add_argument(
         "-clean",
         dest="CLEAN",
         action="store_true",
         help="Clear the cache before processing?",
     )
+    parser.add_argument(
+        "-retry-failed",
+        dest="RETRY_FAILED",
+        action="store_true",
+        help="Retry items that failed in a previous run",
+    )
+    parser.add_argument(
+        "-workers",
+        dest="WORKERS",
+        type=int,
+        default=4,
+        help="Number of items to request and download at the same time",
+    )
+    parser.add_argument(
+        "-perhost",
+        dest="MAX_PER_HOST",
+        type=int,
+        default=4,
+        help="Max number of simultaneous requests to any one host",
+    )
+    parser.add_argument(
+        "-retries",
+        dest="MAX_RETRIES",
+        type=int,
+        default=5,
+        help="Max number of times to retry a throttled or failed request",
+    )
     parser.add_argument(
         "-debug",
         dest="DEBUG",
@@ -57,22 +91,125 @@ def parse_args():
     return args
 
 
+def process_item(a, job):
+    """Request an item's data if it is not cached, then download its image, write its metadata, and copy it to each output"""
+    object_id, item_data, outputs = job
+    image_filenames = [image_filename for _, image_filename in outputs]
+    image_filename = image_filenames[0]
+    result = {
+        "object_id": object_id,
+        "outputs": outputs,
+        "item_data": None,
+        "error": False,
+        "saved": False,
+        "message": "",
+    }
+
+    if item_data is None:
+        # Request data from API
+        api_url = f"https://collectionapi.metmuseum.org/public/collection/v1/objects/{object_id}"
+        fields_to_cache = [
+            "title",
+            "artistDisplayName",
+            "objectDate",
+            "objectURL",
+            "primaryImage",
+        ]
+        response = json_request(api_url)
+        if "error" in response:
+            result["error"] = True
+            result["message"] = (
+                f"{response['error']} error when requesting {api_url}. Skipping."
+            )
+            return result
+
+        # Load data from response
+        item_data = {}
+        for field in fields_to_cache:
+            if field in response:
+                item_data[field] = str(response[field]).strip()
+            else:
+                item_data[field] = ""
+        result["item_data"] = item_data
+
+    if "primaryImage" not in item_data:
+        return result
+
+    # Download and save the image
+    download(item_data["primaryImage"], image_filename, verbose=False)
+    if not os.path.isfile(image_filename):
+        result["error"] = True
+        return result
+
+    # Write metadata to the image file
+    success = write_meta_to_image(
+        image_filename,
+        [
+            ("ImageDescription", item_data["title"]),
+            ("Artist", item_data["artistDisplayName"]),
+            ("DateTime", item_data["objectDate"]),
+            ("ImageID", item_data["objectURL"]),
+        ],
+    )
+
+    if not success:
+        os.remove(image_filename)
+        result["error"] = True
+        result["message"] = f"Could not write meta to {image_filename}. Removing."
+        return result
+
+    # Items that match more than one query are downloaded once and copied
+    for copy_filename in image_filenames[1:]:
+        shutil.copyfile(image_filename, copy_filename)
+
+    result["saved"] = True
+    result["message"] = f"Saved {', '.join(image_filenames)}"
+    return result
+
+
+def read_queries_file(filename):
+    """Read (query, output directory) pairs from a file with one `query -> output directory` per line"""
+    queries = []
+    for line in read_lines(filename):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        if " -> " not in line:
+            print(f"Could not parse line in {filename}: {line}")
+            continue
+        query_string, output_dir = line.rsplit(" -> ", 1)
+        queries.append((query_string.strip(), os.path.join(output_dir.strip(), "")))
+    return queries
+
+
 def main(a):
     """Main function retrieve open access Met images"""
 
-    make_directories([a.CACHE_DIRECTORY, a.OUTPUT_DIR])
+    queries = [(a.QUERY_STRING, os.path.join(a.OUTPUT_DIR, ""))]
+    if a.QUERIES_FILE != "":
+        queries = read_queries_file(a.QUERIES_FILE)
+    output_dirs = [output_dir for _, output_dir in queries]
+
+    make_directories([a.CACHE_DIRECTORY] + output_dirs)
 
     if a.CLEAN:
         empty_directory(a.CACHE_DIRECTORY)
 
+    set_max_requests_per_host(a.MAX_PER_HOST)
+    configure_http_session(pool_size=a.MAX_PER_HOST, max_retries=a.MAX_RETRIES)
+
     # Download the data
     data_source_url = a.DATA_SOURCE
     data_source_fn = data_source_url.split("/")[-1]
     data_source_file = f"{a.CACHE_DIRECTORY}{data_source_fn}"
     download(data_source_url, data_source_file)
 
-    # Read the data
-    items = pd.read_csv(data_source_file)
+    # Read the data; only the columns used here and in the queries are loaded
+    items = read_csv_cached(
+        data_source_file,
+        ["Object ID", "Is Public Domain"],
+        [query_string for query_string, _ in queries],
+    )
     total_items = items.shape[0]
     print(f"{total_items:,} items found.")
 
@@ -81,87 +218,99 @@ def main(a):
     total_pd_items = pd_items.shape[0]
     print(f"{total_pd_items:,} public domain items found.")
 
-    # Filter data by query
-    if a.QUERY_STRING != "":
-        pd_items = pd_items.query(a.QUERY_STRING)
-        total_pd_items = pd_items.shape[0]
-        print(f"{total_pd_items:,} items after filtering with query: {a.QUERY_STRING}")
+    # Find which output directories each item goes to; an item can match more than one query
+    item_outputs = {}
+    for query_string, output_dir in queries:
+        query_items = pd_items
+        if query_string != "":
+            query_items = pd_items.query(query_string)
+            print(
+                f"{query_items.shape[0]:,} items after filtering with query: {query_string}"
+            )
+        for object_id in query_items["Object ID"].astype(str):
+            item_outputs.setdefault(object_id, []).append(output_dir)
+    total_query_items = len(item_outputs)
+    if len(queries) > 1:
+        print(f"{total_query_items:,} unique items in all queries")
 
-    # Reset the index
-    pd_items = pd_items.reset_index()
+    # Queue up items that have not been downloaded to every output yet
+    item_cache = load_cache_file(f"{a.CACHE_DIRECTORY}item_cache.db", {})
+    manifests = {
+        output_dir: RunManifest(f"{output_dir}manifest.db")
+        for output_dir in set(output_dirs)
+    }
+    jobs = []
+    job_indices = []
+    for i, (object_id, item_output_dirs) in enumerate(item_outputs.items()):
+        done_filenames = []
+        # (output directory, image filename) pairs; the directory is the key of its manifest
+        outputs = []
+        for output_dir in item_output_dirs:
+            image_filename = f"{output_dir}met-{object_id}.jpg"
+            if manifests[output_dir].is_done(
+                object_id, a.RETRY_FAILED, image_filename, commit=False
+            ):
+                done_filenames.append(image_filename)
+            else:
+                outputs.append((output_dir, image_filename))
 
-    # Iterate through items
-    item_cache = load_cache_file(f"{a.CACHE_DIRECTORY}item_cache.p", {})
-    errors = 0
-    for i, item in pd_items.iterrows():
-        object_id = str(item["Object ID"])
-        image_filename = f"{a.OUTPUT_DIR}met-{object_id}.jpg"
+        if len(outputs) == 0:
+            continue
 
-        if os.path.isfile(image_filename):
+        # Copy the image if another query already downloaded it
+        done_filenames = [fn for fn in done_filenames if os.path.isfile(fn)]
+        if len(done_filenames) > 0:
+            for output_dir, image_filename in outputs:
+                shutil.copyfile(done_filenames[0], image_filename)
+                manifests[output_dir].record(
+                    object_id, "processed", [image_filename], commit=False
+                )
             continue
 
         # Check to see if item data is cached
         item_data = item_cache[object_id] if object_id in item_cache else None
-        if item_data is None:
-            # Request data from API
-            api_url = f"https://collectionapi.metmuseum.org/public/collection/v1/objects/{object_id}"
-            fields_to_cache = [
-                "title",
-                "artistDisplayName",
-                "objectDate",
-                "objectURL",
-                "primaryImage",
-            ]
-            response = json_request(api_url)
-            if "error" in response:
-                print(f"{response['error']} error when requesting {api_url}. Skipping.")
-                errors += 1
-                time.sleep(1)
-                continue
-
-            # Load data from response
-            item_data = {}
-            for field in fields_to_cache:
-                if field in response:
-                    item_data[field] = str(response[field]).strip()
-                else:
-                    item_data[field] = ""
-
-            # Save response to cache
-            item_cache[object_id] = item_data
-            save_cache_file(f"{a.CACHE_DIRECTORY}item_cache.p", item_cache)
-
-        # Download and save the image
-        if "primaryImage" in item_data:
-            download(item_data["primaryImage"], image_filename, verbose=False)
-            if not os.path.isfile(image_filename):
-                errors += 1
-                time.sleep(1)
-                continue
-
-            # Write metadata to the image file
-            success = write_meta_to_image(
-                image_filename,
-                [
-                    ("ImageDescription", item_data["title"]),
-                    ("Artist", item_data["artistDisplayName"]),
-                    ("DateTime", item_data["objectDate"]),
-                    ("ImageID", item_data["objectURL"]),
-                ],
-            )
+        jobs.append((object_id, item_data, outputs))
+        job_indices.append(i)
+    for manifest in manifests.values():
+        manifest.commit()
 
-            if not success:
-                print(f"Could not write meta to {image_filename}. Removing.")
-                os.remove(image_filename)
-                errors += 1
-                continue
+    # Request and download items in parallel, reporting progress in order
+    errors = 0
+    results = run_jobs(jobs, lambda job: process_item(a, job), a.WORKERS)
+    for i, result in zip(job_indices, results):
+        # Save response to cache
+        if result["item_data"] is not None:
+            item_cache[result["object_id"]] = result["item_data"]
+            save_cache_file(f"{a.CACHE_DIRECTORY}item_cache.db", item_cache)
+
+        for output_dir, image_filename in result["outputs"]:
+            manifest = manifests[output_dir]
+            if result["saved"]:
+                manifest.record(result["object_id"], "processed", [image_filename])
+            elif result["error"]:
+                manifest.record(result["object_id"], "failed", reason=result["message"])
+            else:
+                manifest.record(result["object_id"], "skipped", reason="No image")
 
+        if result["saved"]:
             print(
-                f"{i+1} of {total_pd_items} ({round(100.0*i/total_pd_items,2)}%) Saved {image_filename}"
+                f"{i+1} of {total_query_items} ({round(100.0*i/total_query_items,2)}%) {result['message']}"
             )
+            continue
+
+        if result["error"]:
+            errors += 1
+        if result["message"] != "":
+            print(result["message"])
+
+    item_cache.close()
+    for manifest in manifests.values():
+        manifest.close()
 
     if errors > 0:
-        print(f"Completed with {errors} errors. Re-run to retry failed image downloads")
+        print(
+            f"Completed with {errors} errors. Re-run with -retry-failed to retry failed image downloads"
+        )
     else:
         print("Finished with no errors")
 
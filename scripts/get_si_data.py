@@ -3,12 +3,37 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+from itertools import islice
 import os
 
 import pandas as pd
 
 from utilities import *
 
+# Columns of the output in order, with types that stay the same from one batch to the next
+SI_COLUMN_TYPES = {
+    "id": "string",
+    "title": "string",
+    "unit_code": "string",
+    "record_link": "string",
+    "access": "string",
+    "data_source": "string",
+    "date": "string",
+    "name": "string",
+    "object_type": "string",
+    "object_type_2": "string",
+    "object_type_3": "string",
+    "topic": "string",
+    "place": "string",
+    "group": "string",
+    "description": "string",
+    "medium": "string",
+    "dimensions": "string",
+    "image": "string",
+    "image_width": "Int64",
+    "image_height": "Int64",
+}
+
 
 def parse_args():
     """Function to parse script arguments"""
@@ -36,7 +61,28 @@ def parse_args():
         "-out",
         dest="OUTPUT_FILE",
         default="output/si-chndm-pd.csv",
-        help="Output data file",
+        help="Output data file; use a .parquet extension to write Parquet",
+    )
+    parser.add_argument(
+        "-batch",
+        dest="BATCH_SIZE",
+        type=int,
+        default=10000,
+        help="Number of rows to parse, filter, and write at a time",
+    )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=0,
+        help="Request images no larger than this on their longest side from servers that can resize them (IIIF, ids.si.edu); use the -maxd of the scripts that will process them; 0 for full size",
+    )
+    parser.add_argument(
+        "-workers",
+        dest="WORKERS",
+        type=int,
+        default=4,
+        help="Number of data files to download and parse at the same time",
     )
     parser.add_argument(
         "-clean",
@@ -54,54 +100,69 @@ def parse_args():
     return args
 
 
-def parse_si_json(json_data):
-    """Convert a JSON data item to flat row"""
-    row = {}
+def download_si_shard(a, url):
+    """Download a data file if it is not cached and return its filename, or None if it could not be downloaded"""
+    basename = os.path.basename(url)
+    data_filename = f"{a.CACHE_DIRECTORY}{basename}"
+    download(url, data_filename)
 
-    descriptive = get_nested_value(
-        json_data, ["content", "descriptiveNonRepeating"], {}
-    )
-    structured = get_nested_value(json_data, ["content", "indexedStructured"], {})
-    freetext = get_nested_value(json_data, ["content", "freetext"], {})
-
-    row["id"] = get_nested_value(descriptive, "record_ID")
-    row["title"] = get_nested_value(json_data, "title", "Untitled")
-    row["unit_code"] = get_nested_value(json_data, "unitCode")
-    row["record_link"] = get_nested_value(descriptive, "record_link")
-    row["access"] = get_nested_value(descriptive, ["metadata_usage", "access"])
-    row["data_source"] = get_nested_value(descriptive, "data_source")
-    row["date"] = get_nested_value(structured, ["date", 0])
-    row["name"] = get_nested_value(structured, ["name", 0])
-    row["object_type"] = get_nested_value(structured, ["object_type", 0])
-    row["object_type_2"] = get_nested_value(structured, ["object_type", 1])
-    row["object_type_3"] = get_nested_value(structured, ["object_type", 2])
-    row["topic"] = get_nested_value(structured, ["topic", 0])
-    row["place"] = get_nested_value(structured, ["place", 0])
-
-    sets = get_nested_value(freetext, "setName", [])
-    row["group"] = sets[-1]["content"] if len(sets) > 0 else ""
-
-    notes = get_nested_value(freetext, "notes", [])
-    row["description"] = get_where(notes, "content", ("label", "Description"))
-
-    physical_descriptions = get_nested_value(freetext, "physicalDescription", [])
-    row["medium"] = get_where(physical_descriptions, "content", ("label", "Medium"))
-    row["dimensions"] = get_where(
-        physical_descriptions, "content", ("label", "Dimensions")
-    )
+    if not os.path.isfile(data_filename):
+        print(f"Could not download data file: {url}")
+        return None
+
+    return data_filename
 
-    resources = get_nested_value(
-        descriptive, ["online_media", "media", 0, "resources"], []
+
+def set_image_sizes(df, max_dimension):
+    """Point image URLs at versions no larger than a max dimension"""
+    sized_urls = []
+    for url, width, height in zip(df["image"], df["image_width"], df["image_height"]):
+        if pd.notna(url) and pd.notna(width) and pd.notna(height):
+            url = get_sized_image_url(url, max_dimension, width, height)
+        sized_urls.append(url)
+    df = df.copy()
+    df["image"] = pd.array(sized_urls, dtype=SI_COLUMN_TYPES["image"])
+    return df
+
+
+def get_si_frame(rows, start, query_string):
+    """Convert a batch of rows to a DataFrame indexed from a starting row and filter it"""
+    df = pd.DataFrame(
+        rows, columns=list(SI_COLUMN_TYPES), index=range(start, start + len(rows))
     )
-    resources = [r for r in resources if "height" in r]
-    if len(resources) > 0:
-        resources = sorted(resources, key=lambda r: -r["height"])
-        largest_resource = resources[0]
-        row["image"] = largest_resource["url"]
-        row["image_width"] = largest_resource["width"]
-        row["image_height"] = largest_resource["height"]
+    df = df.astype(SI_COLUMN_TYPES)
 
-    return row
+    # Filter data by query
+    if query_string != "":
+        df = df.query(query_string)
+
+    return df
+
+
+def iter_si_pieces(filenames, query_string, batch_size):
+    """Yield a parse job for each batch of rows in the data files: where in its file the batch starts, and its first row across all files"""
+    start = 0
+    for filename in filenames:
+        count = 0
+        offset = 0
+        with open(filename, "rb") as f:
+            for line in f:
+                # Blank lines are skipped when parsing, so they don't count as rows
+                if line.strip():
+                    if count % batch_size == 0:
+                        yield filename, offset, start + count, query_string, batch_size
+                    count += 1
+                offset += len(line)
+        start += count
+
+
+def read_si_piece(job):
+    """Parse and filter one batch of rows from a data file; returns (row count, filtered DataFrame)"""
+    filename, offset, start, query_string, batch_size = job
+    items = iter_line_delimited_json(filename, offset)
+    rows = [parse_si_json(item) for item in islice(items, batch_size)]
+    items.close()
+    return len(rows), get_si_frame(rows, start, query_string)
 
 
 def main(a):
@@ -119,36 +180,43 @@ def main(a):
         print(f"Could not download index file: {a.DATA_SOURCE}")
         return
 
-    # Download data from each URL
+    # Download data from each URL; finish before forking parse workers so no download threads are running
     data_urls = read_lines(index_filename)
-    data_rows = []
-    for url in data_urls:
-        basename = os.path.basename(url)
-        data_filename = f"{a.CACHE_DIRECTORY}{basename}"
-        download(url, data_filename)
-
-        if not os.path.isfile(data_filename):
-            print(f"Could not download data file: {url}")
-            continue
-
-        data = read_line_delimited_json(data_filename)
-        for row in data:
-            data_row = parse_si_json(row)
-            data_rows.append(data_row)
-
-    # Convert to a DataFrame
-    df = pd.DataFrame(data_rows)
-    total_items = df.shape[0]
-    print(f"{total_items:,} items found.")
+    workers = max(1, a.WORKERS)
+    batch_size = max(1, a.BATCH_SIZE)
+    set_max_requests_per_host(workers)
+    data_filenames = run_jobs(data_urls, lambda url: download_si_shard(a, url), workers)
+    data_filenames = [fn for fn in data_filenames if fn is not None]
+
+    # Parse batches in parallel; results come back in file order so the output is the same for any number of workers.
+    # Each job is a single batch, so only about one batch per worker is in memory at a time
+    batches = run_jobs(
+        iter_si_pieces(data_filenames, a.QUERY_STRING, batch_size),
+        read_si_piece,
+        workers,
+        processes=True,
+    )
 
-    # Filter data by query
-    if a.QUERY_STRING != "":
-        df = df.query(a.QUERY_STRING)
-        total_items = df.shape[0]
-        print(f"{total_items:,} items after filtering with query: {a.QUERY_STRING}")
+    writer = TableWriter(a.OUTPUT_FILE)
+    total_items = 0
+    total_written = 0
+    batch_count = 0
+    for row_count, df in batches:
+        if a.MAX_IMAGE_DIMENSION > 0:
+            df = set_image_sizes(df, a.MAX_IMAGE_DIMENSION)
+        writer.write(df)
+        total_items += row_count
+        total_written += len(df)
+        batch_count += 1
+
+    # Make sure the file has a header even if it is empty
+    if batch_count == 0:
+        writer.write(get_si_frame([], 0, a.QUERY_STRING))
+    writer.close()
 
-    # Write to file
-    df.to_csv(a.OUTPUT_FILE)
+    print(f"{total_items:,} items found.")
+    if a.QUERY_STRING != "":
+        print(f"{total_written:,} items after filtering with query: {a.QUERY_STRING}")
     print(f"Wrote items to {a.OUTPUT_FILE}")
 
 
@@ -3,8 +3,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+from collections import Counter
+
 import pandas as pd
 
+from data_utilities import *
 from utilities import *
 
 
@@ -16,7 +19,7 @@ def parse_args():
         "-src",
         dest="DATA_SOURCE",
         default="cache/met-open-access-objects/MetObjects.csv",
-        help="Path to csv data file",
+        help="Path to csv or parquet data file; separate multiple files (or glob patterns) with commas",
     )
     parser.add_argument(
         "-query",
@@ -36,31 +39,51 @@ def parse_args():
         default="output/met_{id}.csv",
         help="Output data file pattern",
     )
+    parser.add_argument(
+        "-chunk",
+        dest="CHUNK_SIZE",
+        type=int,
+        default=100000,
+        help="Number of rows to read at a time",
+    )
     args = parser.parse_args()
     return args
 
 
 def main(a):
-    """Main function retrieve stats from a csv data file"""
+    """Main function retrieve stats from one or more csv data files"""
 
-    # Read the data
-    items = pd.read_csv(a.DATA_SOURCE)
-    total_items = items.shape[0]
+    filenames = []
+    for file_string in a.DATA_SOURCE.split(","):
+        filenames += get_filenames(file_string.strip())
+    cols = [col.strip() for col in a.COLUMN_NAMES.split(",")]
+
+    # Read each file a chunk at a time, counting the values of every column in one pass
+    counts = {col: Counter() for col in cols}
+    found_cols = set()
+    total_items = 0
+    total_filtered = 0
+    for filename in filenames:
+        chunks = iter_table_chunks(filename, cols, a.QUERY_STRING, a.CHUNK_SIZE)
+        for row_count, chunk in chunks:
+            total_items += row_count
+            total_filtered += chunk.shape[0]
+            for col in cols:
+                if col in chunk.columns:
+                    found_cols.add(col)
+                    counts[col].update(chunk[col].value_counts().to_dict())
     print(f"{total_items:,} items found.")
 
-    # Filter data by query
     if a.QUERY_STRING != "":
-        items.query(a.QUERY_STRING, inplace=True)
-        total_items = items.shape[0]
-        print(f"{total_items:,} items after filtering with query string.")
-
-    cols = [col.strip() for col in a.COLUMN_NAMES.split(",")]
+        print(f"{total_filtered:,} items after filtering with query string.")
 
     for col in cols:
-        if col in items.columns:
+        if col in found_cols:
             col_id = string_to_filename(col)
             filename = a.OUTPUT_FILE.format(id=col_id)
-            value_counts = items[col].value_counts()
+            value_counts = pd.Series(counts[col], name="count", dtype="int64")
+            value_counts.index.name = col
+            value_counts = value_counts.sort_values(ascending=False, kind="stable")
             value_counts.to_csv(filename)
             print(f"Created {filename}")
         else:
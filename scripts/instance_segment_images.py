@@ -1,19 +1,13 @@
-"""Script for retrieving dates from transcripts"""
+"""Script for segmenting common objects in images with Mask R-CNN"""
 
 # -*- coding: utf-8 -*-
 
 import argparse
-import numpy as np
-import matplotlib.pyplot as plt
-import torch
-from torchvision.io import read_image
-from torchvision.models.detection import (
-    maskrcnn_resnet50_fpn,
-    MaskRCNN_ResNet50_FPN_Weights,
-)
-from torchvision.transforms.functional import to_pil_image
-from torchvision.utils import draw_segmentation_masks
+import os
 
+import cv2
+
+from model_utilities import *
 from utilities import *
 
 
@@ -35,14 +29,35 @@ def parse_args():
         dest="SEGMENT_THRESHOLD",
         type=float,
         default=0.95,
-        help="Threshold for considering something a threshold (0-1, where 0 gives you everything)",
+        help="Min detection score for keeping a segment (0-1, where 0 gives you everything)",
     )
     parser.add_argument(
         "-mask",
         dest="MASK_THRESHOLD",
         type=float,
         default=0.5,
-        help="Threshold for cropping mask",
+        help="Min mask probability for a pixel to be part of a segment (0-1)",
+    )
+    parser.add_argument(
+        "-maxd",
+        dest="MAX_IMAGE_DIMENSION",
+        type=int,
+        default=4000,
+        help="Max dimension of a source image; image will be resized before processing",
+    )
+    parser.add_argument(
+        "-batch",
+        dest="BATCH_SIZE",
+        type=int,
+        default=4,
+        help="Number of images to run through the model at the same time",
+    )
+    parser.add_argument(
+        "-procs",
+        dest="PROCESSES",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard the images across; each needs its own memory for the model's activations, so N processes need about N times the peak memory of one",
     )
     parser.add_argument(
         "-clean",
@@ -50,6 +65,12 @@ def parse_args():
         action="store_true",
         help="Clear the output directory before processing?",
     )
+    parser.add_argument(
+        "-retry-failed",
+        dest="RETRY_FAILED",
+        action="store_true",
+        help="Retry images that failed in a previous run",
+    )
     parser.add_argument(
         "-debug",
         dest="DEBUG",
@@ -60,16 +81,94 @@ def parse_args():
     return args
 
 
-def show(imgs):
-    if not isinstance(imgs, list):
-        imgs = [imgs]
-    fig, axs = plt.subplots(ncols=len(imgs), squeeze=False)
-    for i, img in enumerate(imgs):
-        img = img.detach()
-        img = to_pil_image(img)
-        axs[0, i].imshow(np.asarray(img))
-        axs[0, i].set(xticklabels=[], yticklabels=[], xticks=[], yticks=[])
-    plt.show()
+def read_batch(context, batch):
+    """Read a batch of images"""
+    a = context["a"]
+    return [load_image(fn, a.MAX_IMAGE_DIMENSION) for _, fn in batch]
+
+
+def segment_batch(context, batch, images, report):
+    """Detect the instances in a batch of images"""
+    a = context["a"]
+    detector = context["detector"]
+    manifest = context["manifest"]
+    file_count = context["file_count"]
+
+    readable = []
+    for j, (i, fn) in enumerate(batch):
+        report(f"Processing {i+1} of {file_count}: {fn}")
+        if images[j] is None:
+            report(f"Could not read file {fn}; skipping")
+            manifest.record(fn, "failed", reason="Could not read file")
+            continue
+        readable.append(j)
+    if len(readable) == 0:
+        return []
+
+    # Run the whole batch at once, falling back to one image at a time if it doesn't fit in memory
+    instances = None
+    if len(readable) > 1:
+        try:
+            instances = detect_instances(
+                detector, [images[j] for j in readable], a.MASK_THRESHOLD
+            )
+        except RuntimeError as error:
+            report(f"Error with batch; detecting images one at a time: {error}")
+
+    results = []
+    for k, j in enumerate(readable):
+        fn = batch[j][1]
+        if instances is not None:
+            image_instances = instances[k]
+        else:
+            try:
+                image_instances = detect_instances(
+                    detector, [images[j]], a.MASK_THRESHOLD
+                )[0]
+            except RuntimeError as error:
+                report(f"Error with file {fn}; skipping: {error}")
+                manifest.record(fn, "failed", reason=str(error))
+                continue
+        results.append((fn, images[j], image_instances))
+
+    return results
+
+
+def write_batch(context, results):
+    """Write the segments of a batch of images to file"""
+    a = context["a"]
+    manifest = context["manifest"]
+    for fn, image, instances in results:
+        segment_fns = []
+        for j, instance in enumerate(instances):
+            segment_fn = f"{a.OUTPUT_DIR}/{get_basename(fn)}-{j+1}.png"
+            cropped_image = extract_segment(
+                image, instance["segmentation"], instance["bbox"]
+            )
+            cv2.imwrite(segment_fn, cropped_image)
+            segment_fns.append(segment_fn)
+
+        if len(segment_fns) > 0:
+            manifest.record(fn, "processed", segment_fns)
+        else:
+            manifest.record(fn, "skipped", reason="No instances above the threshold")
+
+
+def segment_files(context, files, report):
+    """Segment a list of (index, filename) pairs and write the segments to file"""
+    a = context["a"]
+    batch_size = max(1, a.BATCH_SIZE)
+    batches = [
+        files[start : start + batch_size] for start in range(0, len(files), batch_size)
+    ]
+
+    # Read the next batch and write the previous one while the model runs
+    run_pipeline(
+        batches,
+        lambda batch: read_batch(context, batch),
+        lambda batch, images: segment_batch(context, batch, images, report),
+        lambda batch, results: write_batch(context, results),
+    )
 
 
 def main(a):
@@ -82,38 +181,44 @@ def main(a):
     if a.CLEAN:
         empty_directory(a.OUTPUT_DIR)
 
-    plt.rcParams["savefig.bbox"] = "tight"
-
     filenames = get_filenames(a.INPUT_FILES)
-    fileCount = len(filenames)
-    print(f"{fileCount} files found.")
-
-    weights = MaskRCNN_ResNet50_FPN_Weights.DEFAULT
-    transforms = weights.transforms()
-
-    model = maskrcnn_resnet50_fpn(weights=weights, progress=False)
-    model = model.eval()
+    file_count = len(filenames)
+    print(f"{file_count} files found.")
+
+    detector = get_detector(a.SEGMENT_THRESHOLD)
+
+    # Images are re-processed if any of the parameters that affect the output change
+    manifest = RunManifest(
+        os.path.join(a.OUTPUT_DIR, "manifest.db"),
+        {
+            "SEGMENT_THRESHOLD": a.SEGMENT_THRESHOLD,
+            "MASK_THRESHOLD": a.MASK_THRESHOLD,
+            "MAX_IMAGE_DIMENSION": a.MAX_IMAGE_DIMENSION,
+        },
+    )
 
+    # Queue up the files that have not been processed yet
+    pending = []
     for i, fn in enumerate(filenames):
-        existsFn = f"{a.OUTPUT_DIR}/{get_basename(fn)}-1.png"
-        if os.path.isfile(existsFn):
-            print(f"Already processed {i+1} of {fileCount}: {fn}")
+        exists_fn = f"{a.OUTPUT_DIR}/{get_basename(fn)}-1.png"
+        if manifest.is_done(fn, a.RETRY_FAILED, exists_fn, commit=False):
+            print(f"Already processed {i+1} of {file_count}: {fn}")
             continue
-        print(f"Processing {i+1} of {fileCount}: {fn}")
-
-        img = transforms(read_image(fn))
-        output = model([img])
-        output = output[0]
-        masks = output["masks"][output["scores"] > a.SEGMENT_THRESHOLD]
-        # masks = masks > a.MASK_THRESHOLD
-        masks = masks.squeeze(1)
-
-        for mask in masks:
-            print(mask.dtype)
-            segment_image = to_pil_image(mask)
-            print(segment_image.size)
-            segment_image.show()
-        break
+        pending.append((i, fn))
+    manifest.commit()
+
+    # Workers share the model's weights instead of each loading a copy
+    if a.PROCESSES > 1:
+        detector.share_memory()
+
+    context = {
+        "a": a,
+        "detector": detector,
+        "manifest": manifest,
+        "file_count": file_count,
+    }
+    process_files(pending, segment_files, context, a.PROCESSES)
+    manifest.close()
 
 
 main(parse_args())
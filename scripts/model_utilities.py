@@ -0,0 +1,663 @@
+"""Utility functions to support the segmentation scripts"""
+
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import queue
+
+import numpy as np
+from segment_anything import SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
+import torch
+import torch.nn.functional as F
+from torchvision.models.detection import (
+    maskrcnn_resnet50_fpn,
+    MaskRCNN_ResNet50_FPN_Weights,
+)
+
+# Names of the COCO classes that the Mask R-CNN detector labels instances with
+DETECTOR_CATEGORIES = MaskRCNN_ResNet50_FPN_Weights.DEFAULT.meta["categories"]
+
+# Set in the parent process before forking so workers inherit the model without pickling it
+WORKER_CONTEXT = None
+
+
+class EmbeddingCache:
+    """On-disk cache of SAM image embeddings that evicts the least recently used when full"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory.rstrip("/")
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def evict(self):
+        """Remove the least recently used embeddings until the cache fits its max size"""
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            for filename in [path, f"{os.path.splitext(path)[0]}.json"]:
+                # Another process may have evicted it already
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+
+    def get(self, key):
+        """Return a cached embedding, or None if it is not cached"""
+        features_fn = f"{self.directory}/{key}.npy"
+        meta_fn = f"{self.directory}/{key}.json"
+        if not os.path.isfile(features_fn) or not os.path.isfile(meta_fn):
+            return None
+        try:
+            with open(meta_fn, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            # Memory-map the features; copy-on-write so torch gets a writable array
+            features = np.load(features_fn, mmap_mode="c")
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(features_fn)
+        return {
+            "features": torch.from_numpy(features),
+            "original_size": tuple(meta["original_size"]),
+            "input_size": tuple(meta["input_size"]),
+        }
+
+    def get_key(self, filename, model, max_dimension):
+        """Return a cache key from a file's contents, the model, and the resize dimension"""
+        file_hash = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+        return f"{file_hash.hexdigest()}-{model}-{max_dimension}"
+
+    def put(self, key, embedding):
+        """Save an embedding to the cache"""
+        features_fn = f"{self.directory}/{key}.npy"
+        meta_fn = f"{self.directory}/{key}.json"
+        features = embedding["features"].detach().cpu().numpy().astype(np.float32)
+        # Write to temporary files first so readers never see a partial embedding
+        with open(f"{meta_fn}.tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "original_size": list(embedding["original_size"]),
+                    "input_size": list(embedding["input_size"]),
+                },
+                f,
+            )
+        with open(f"{features_fn}.tmp", "wb") as f:
+            np.save(f, features)
+        os.replace(f"{meta_fn}.tmp", meta_fn)
+        os.replace(f"{features_fn}.tmp", features_fn)
+        self.evict()
+
+
+class EmbeddingPredictor(SamPredictor):
+    """SAM predictor that can be given a precomputed image embedding instead of running the image encoder"""
+
+    def __init__(self, sam_model):
+        super().__init__(sam_model)
+        self.has_preset_embedding = False
+
+    def reset_image(self):
+        """Clear the image embedding, including one set with set_embedding"""
+        super().reset_image()
+        self.has_preset_embedding = False
+
+    def set_embedding(self, embedding):
+        """Use a precomputed embedding for the next image"""
+        self.reset_image()
+        self.features = embedding["features"].to(self.device)
+        self.original_size = embedding["original_size"]
+        self.input_size = embedding["input_size"]
+        self.is_image_set = True
+        self.has_preset_embedding = True
+
+    def set_image(self, image, image_format="RGB"):
+        """Compute the image embedding, unless one was already set with set_embedding"""
+        # The automatic mask generator calls this itself, so skip the encoder if we already have an embedding
+        if self.has_preset_embedding:
+            self.has_preset_embedding = False
+            return
+        super().set_image(image, image_format)
+
+
+def compact_mask(mask, offset=(0, 0)):
+    """Crop a SAM mask (binary or uncompressed RLE) to its bounding box, moving the box into the coordinates of a larger image"""
+    x, y, w, h = [int(v) for v in mask["bbox"]]
+    segmentation = mask["segmentation"]
+    is_rle = isinstance(segmentation, dict)
+    im_h, im_w = segmentation["size"] if is_rle else segmentation.shape
+    # SAM's box width and height exclude the last row and column of the mask
+    x2 = min(im_w, x + w + 1)
+    y2 = min(im_h, y + h + 1)
+    if is_rle:
+        segmentation = rle_to_cropped_mask(segmentation, (x, y, x2, y2))
+    else:
+        segmentation = segmentation[y:y2, x:x2].copy()
+    offset_x, offset_y = offset
+    return {
+        "segmentation": segmentation,
+        "bbox": [x + offset_x, y + offset_y, x2 - x, y2 - y],
+        "area": int(mask["area"]),
+    }
+
+
+@torch.inference_mode()
+def detect_instances(detector, images, mask_threshold=0.5):
+    """Run Mask R-CNN on a batch of RGB images and return a list of compact masks with scores and labels for each image; a boxes-only detector returns no segmentation and the box's area"""
+    device = next(detector.parameters()).device
+    inputs = [
+        torch.from_numpy(image).to(device).permute(2, 0, 1).float().div(255)
+        for image in images
+    ]
+    outputs = detector(inputs)
+
+    results = []
+    for image, output in zip(images, outputs):
+        im_h, im_w, _ = image.shape
+        instances = []
+        masks = output.get("masks")
+        for k, (box, score, label) in enumerate(
+            zip(
+                output["boxes"].tolist(),
+                output["scores"].tolist(),
+                output["labels"].tolist(),
+            )
+        ):
+            x1 = max(0, int(box[0]))
+            y1 = max(0, int(box[1]))
+            x2 = min(im_w, int(math.ceil(box[2])))
+            y2 = min(im_h, int(math.ceil(box[3])))
+            if x2 <= x1 or y2 <= y1:
+                continue
+            segmentation = None
+            area = (x2 - x1) * (y2 - y1)
+            if masks is not None:
+                # Masks are pasted into the full frame as probabilities; keep just the box
+                segmentation = (
+                    (masks[k, 0, y1:y2, x1:x2] > mask_threshold).cpu().numpy()
+                )
+                area = int(np.count_nonzero(segmentation))
+            if area == 0:
+                continue
+            instances.append(
+                {
+                    "segmentation": segmentation,
+                    "bbox": [x1, y1, x2 - x1, y2 - y1],
+                    "area": area,
+                    "score": score,
+                    "label": DETECTOR_CATEGORIES[label],
+                }
+            )
+        results.append(instances)
+
+    return results
+
+
+def encode_images(sam, images):
+    """Run the SAM image encoder on a batch of RGB images and return an embedding per image"""
+    transform = ResizeLongestSide(sam.image_encoder.img_size)
+    input_images = []
+    embeddings = []
+    for image in images:
+        input_image = transform.apply_image(image)
+        input_image_torch = torch.as_tensor(input_image, device=sam.device)
+        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None]
+        input_images.append(sam.preprocess(input_image_torch))
+        embeddings.append(
+            {
+                "original_size": image.shape[:2],
+                "input_size": tuple(input_image_torch.shape[-2:]),
+            }
+        )
+
+    with torch.inference_mode():
+        features = sam.image_encoder(torch.cat(input_images, dim=0))
+
+    for i, embedding in enumerate(embeddings):
+        embedding["features"] = features[i : i + 1]
+
+    return embeddings
+
+
+def generate_tiled_masks(mask_generator, image, tile_size, overlap, min_iou=0.5):
+    """Generate compact masks for an image tile by tile, merging masks that continue across tile seams"""
+    im_h, im_w, _ = image.shape
+    tiles = get_tiles(im_w, im_h, tile_size, overlap)
+    tile_masks = []
+    for x1, y1, x2, y2 in tiles:
+        tile_image = np.ascontiguousarray(image[y1:y2, x1:x2])
+        tile_masks.append(
+            [
+                compact_mask(mask, (x1, y1))
+                for mask in mask_generator.generate(tile_image)
+            ]
+        )
+
+    # A mask can only continue into another tile where the two tiles overlap, so only pair up masks that meet in a seam
+    matches = []
+    for a in range(len(tiles)):
+        for b in range(a + 1, len(tiles)):
+            seam = intersect_boxes(tiles[a], tiles[b])
+            if seam is None:
+                continue
+            for i, j in get_seam_pairs(tile_masks[a], tile_masks[b], seam):
+                iou = get_mask_iou(tile_masks[a][i], tile_masks[b][j], seam)
+                if iou >= min_iou:
+                    matches.append((iou, (a, i), (b, j), seam))
+
+    # Merge the closest matches first, checking each against everything already merged into its group,
+    # so a small mask that matches part of a group can't chain unrelated masks together
+    group_of = {}
+    members = {}
+    merged = {}
+    for t, masks in enumerate(tile_masks):
+        for i, mask in enumerate(masks):
+            group_of[(t, i)] = (t, i)
+            members[(t, i)] = [(t, i)]
+            merged[(t, i)] = mask
+
+    for _, key_a, key_b, seam in sorted(matches, key=lambda match: -match[0]):
+        group_a = group_of[key_a]
+        group_b = group_of[key_b]
+        if group_a == group_b:
+            continue
+        if get_mask_iou(merged[group_a], merged[group_b], seam) < min_iou:
+            continue
+        merged[group_a] = merge_compact_masks([merged[group_a], merged.pop(group_b)])
+        for key in members.pop(group_b):
+            group_of[key] = group_a
+            members[group_a].append(key)
+
+    return list(merged.values())
+
+
+def get_detector(score_threshold=0.05, pretrained=True, with_masks=True):
+    """Return a Mask R-CNN instance segmentation model in inference mode, on the GPU if there is one; without masks it only detects boxes"""
+    # Detections below the threshold are dropped before their masks are pasted into the full frame
+    if pretrained:
+        detector = maskrcnn_resnet50_fpn(
+            weights=MaskRCNN_ResNet50_FPN_Weights.DEFAULT,
+            progress=False,
+            box_score_thresh=score_threshold,
+        )
+    else:
+        detector = maskrcnn_resnet50_fpn(
+            weights=None, weights_backbone=None, box_score_thresh=score_threshold
+        )
+    # Without its mask RoI pooling, Mask R-CNN skips the mask head and doesn't paste any masks
+    if not with_masks:
+        detector.roi_heads.mask_roi_pool = None
+    detector = detector.eval()
+    if torch.cuda.is_available():
+        detector.to(device="cuda")
+    return detector
+
+
+def get_embedding(predictor, image, cache=None, key=None):
+    """Return the SAM embedding of an image, using the embedding cache if one is given"""
+    if cache is not None:
+        embedding = cache.get(key)
+        if embedding is not None:
+            return embedding
+
+    # Make sure the encoder runs even if the last image's embedding was set but never used by set_image
+    predictor.reset_image()
+    predictor.set_image(image)
+    embedding = {
+        "features": predictor.features,
+        "original_size": predictor.original_size,
+        "input_size": predictor.input_size,
+    }
+    if cache is not None:
+        cache.put(key, embedding)
+    return embedding
+
+
+def get_embedding_cache(directory, max_gigabytes):
+    """Return an embedding cache for a directory, or None if no directory is given"""
+    if directory == "":
+        return None
+    return EmbeddingCache(directory, int(max_gigabytes * 1024**3))
+
+
+def get_mask_iou(mask_a, mask_b, box):
+    """Return the intersection over union of two compact masks within a box (x1, y1, x2, y2)"""
+    bbox_a = xywh_to_xyxy(mask_a["bbox"])
+    bbox_b = xywh_to_xyxy(mask_b["bbox"])
+    if intersect_boxes(bbox_a, bbox_b) is None:
+        return 0.0
+
+    # Only look at the part of the box that either mask covers
+    region = intersect_boxes(
+        box,
+        (
+            min(bbox_a[0], bbox_b[0]),
+            min(bbox_a[1], bbox_b[1]),
+            max(bbox_a[2], bbox_b[2]),
+            max(bbox_a[3], bbox_b[3]),
+        ),
+    )
+    if region is None:
+        return 0.0
+
+    region_a = get_mask_region(mask_a, region)
+    region_b = get_mask_region(mask_b, region)
+    union = np.count_nonzero(region_a | region_b)
+    if union == 0:
+        return 0.0
+    return np.count_nonzero(region_a & region_b) / union
+
+
+def get_mask_region(mask, box):
+    """Return the part of a compact mask within a box (x1, y1, x2, y2)"""
+    x1, y1, x2, y2 = box
+    region = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+    mask_x1, mask_y1, mask_x2, mask_y2 = xywh_to_xyxy(mask["bbox"])
+    shared = intersect_boxes(box, (mask_x1, mask_y1, mask_x2, mask_y2))
+    if shared is None:
+        return region
+
+    sx1, sy1, sx2, sy2 = shared
+    region[sy1 - y1 : sy2 - y1, sx1 - x1 : sx2 - x1] = mask["segmentation"][
+        sy1 - mask_y1 : sy2 - mask_y1, sx1 - mask_x1 : sx2 - mask_x1
+    ]
+    return region
+
+
+def get_seam_pairs(masks_a, masks_b, seam, cell_size=64):
+    """Return the index pairs (i, j) of masks from two tiles whose boxes overlap each other within the seam (x1, y1, x2, y2) between the tiles"""
+    seam_x1, seam_y1, _, _ = seam
+
+    def get_cells(mask):
+        box = intersect_boxes(xywh_to_xyxy(mask["bbox"]), seam)
+        if box is None:
+            return []
+        x1, y1, x2, y2 = box
+        return [
+            (cell_x, cell_y)
+            for cell_y in range(
+                (y1 - seam_y1) // cell_size, (y2 - 1 - seam_y1) // cell_size + 1
+            )
+            for cell_x in range(
+                (x1 - seam_x1) // cell_size, (x2 - 1 - seam_x1) // cell_size + 1
+            )
+        ]
+
+    # Index the second tile's masks by the cells of the seam their boxes cover
+    cells = {}
+    for j, mask in enumerate(masks_b):
+        for cell in get_cells(mask):
+            cells.setdefault(cell, []).append(j)
+
+    pairs = []
+    for i, mask in enumerate(masks_a):
+        candidates = set()
+        for cell in get_cells(mask):
+            candidates.update(cells.get(cell, []))
+        box_a = xywh_to_xyxy(mask["bbox"])
+        for j in sorted(candidates):
+            shared = intersect_boxes(box_a, xywh_to_xyxy(masks_b[j]["bbox"]))
+            if shared is not None and intersect_boxes(shared, seam) is not None:
+                pairs.append((i, j))
+    return pairs
+
+
+def get_tiles(width, height, tile_size, overlap):
+    """Return boxes (x1, y1, x2, y2) of overlapping tiles that cover an image"""
+    step = max(1, tile_size - overlap)
+
+    def get_starts(length):
+        if length <= tile_size:
+            return [0]
+        starts = list(range(0, length - tile_size, step))
+        return starts + [length - tile_size]
+
+    return [
+        (x, y, min(width, x + tile_size), min(height, y + tile_size))
+        for y in get_starts(height)
+        for x in get_starts(width)
+    ]
+
+
+def intersect_boxes(box_a, box_b):
+    """Return the intersection of two boxes (x1, y1, x2, y2), or None if they do not overlap"""
+    x1 = max(box_a[0], box_b[0])
+    y1 = max(box_a[1], box_b[1])
+    x2 = min(box_a[2], box_b[2])
+    y2 = min(box_a[3], box_b[3])
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return (x1, y1, x2, y2)
+
+
+def merge_compact_masks(masks):
+    """Combine compact masks into a single compact mask"""
+    boxes = [xywh_to_xyxy(mask["bbox"]) for mask in masks]
+    x1 = min(box[0] for box in boxes)
+    y1 = min(box[1] for box in boxes)
+    x2 = max(box[2] for box in boxes)
+    y2 = max(box[3] for box in boxes)
+    segmentation = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+    for mask, (mask_x1, mask_y1, mask_x2, mask_y2) in zip(masks, boxes):
+        segmentation[mask_y1 - y1 : mask_y2 - y1, mask_x1 - x1 : mask_x2 - x1] |= mask[
+            "segmentation"
+        ]
+    return {
+        "segmentation": segmentation,
+        "bbox": [x1, y1, x2 - x1, y2 - y1],
+        "area": int(np.count_nonzero(segmentation)),
+    }
+
+
+@torch.no_grad()
+def predict_box_masks(predictor, boxes, batch_size=64):
+    """Decode a mask for each box prompt (x1, y1, x2, y2) in batches, returning each mask cropped to its box"""
+    model = predictor.model
+    masks = []
+    for start in range(0, len(boxes), batch_size):
+        batch = boxes[start : start + batch_size]
+        boxes_torch = torch.as_tensor(batch, dtype=torch.float, device=predictor.device)
+        boxes_torch = predictor.transform.apply_boxes_torch(
+            boxes_torch, predictor.original_size
+        )
+        sparse_embeddings, dense_embeddings = model.prompt_encoder(
+            points=None, boxes=boxes_torch, masks=None
+        )
+        low_res_masks, _ = model.mask_decoder(
+            image_embeddings=predictor.features,
+            image_pe=model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=False,
+        )
+
+        # Only upscale the part of each mask within its box instead of the whole frame
+        for low_res_mask, box in zip(low_res_masks, batch):
+            masks.append(upscale_mask_region(predictor, low_res_mask, box))
+
+    return masks
+
+
+def process_files(files, process_fn, context, procs=1):
+    """Run process_fn(context, files, report) on a list of files, sharding the files across forked worker processes if procs > 1"""
+    if procs > 1 and torch.cuda.is_available():
+        print("CUDA does not support forked workers; using a single process")
+        procs = 1
+    if procs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("Forked workers are not supported here; using a single process")
+        procs = 1
+
+    if procs <= 1:
+        process_fn(context, files, print)
+        return
+
+    # Workers inherit the model through fork; its weights are shared instead of copied
+    global WORKER_CONTEXT
+    WORKER_CONTEXT = (process_fn, context)
+    threads = max(1, torch.get_num_threads() // procs)
+    print(f"Processing with {procs} processes of {threads} threads each")
+
+    mp_context = multiprocessing.get_context("fork")
+    messages = mp_context.Queue()
+    workers = []
+    for shard in range(procs):
+        shard_files = files[shard::procs]
+        if len(shard_files) == 0:
+            continue
+        worker = mp_context.Process(
+            target=run_worker, args=(shard_files, threads, messages)
+        )
+        worker.start()
+        workers.append((shard, shard_files, worker))
+
+    # Print progress from all the workers as it comes in
+    finished = 0
+    while finished < len(workers):
+        try:
+            message = messages.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for _, _, worker in workers):
+                break
+            continue
+        if message is None:
+            finished += 1
+        else:
+            print(message)
+
+    for _, _, worker in workers:
+        worker.join()
+
+    # A worker that was killed, e.g. for running out of memory, never reports the files it didn't get to
+    failed_shards = []
+    manifest = context.get("manifest")
+    if manifest is not None:
+        manifest.reload()
+    for shard, shard_files, worker in workers:
+        if worker.exitcode == 0:
+            continue
+        reason = (
+            f"Worker process {shard+1} of {procs} exited with code {worker.exitcode}"
+        )
+        print(f"{reason}; its unfinished files were not processed")
+        failed_shards.append(shard)
+        if manifest is None:
+            continue
+        for _, fn in shard_files:
+            if not manifest.is_current(fn):
+                manifest.record(fn, "failed", reason=reason, commit=False)
+        manifest.commit()
+
+    if len(failed_shards) > 0:
+        raise RuntimeError(
+            f"{len(failed_shards)} of {len(workers)} worker processes did not finish; re-run with -retry-failed or fewer -procs"
+        )
+
+
+def rle_to_cropped_mask(rle, box):
+    """Decode only the part of an uncompressed RLE mask within a box (x1, y1, x2, y2)"""
+    im_h, _ = rle["size"]
+    x1, y1, x2, y2 = box
+
+    # SAM's RLE runs go down each column in turn, so a range of columns is one contiguous range of runs
+    start = x1 * im_h
+    end = x2 * im_h
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    run_ends = np.cumsum(counts)
+    run_starts = run_ends - counts
+
+    # Odd runs are foreground; clip them to the columns we want
+    run_starts = np.clip(run_starts[1::2], start, end) - start
+    run_ends = np.clip(run_ends[1::2], start, end) - start
+    changes = np.zeros(end - start + 1, dtype=np.int32)
+    np.add.at(changes, run_starts, 1)
+    np.add.at(changes, run_ends, -1)
+    columns = np.cumsum(changes[:-1]) > 0
+
+    return np.ascontiguousarray(columns.reshape(x2 - x1, im_h)[:, y1:y2].T)
+
+
+def run_worker(files, threads, messages):
+    """Process a shard of files in a forked worker process"""
+    torch.set_num_threads(threads)
+    process_fn, context = WORKER_CONTEXT
+    try:
+        process_fn(context, files, messages.put)
+    finally:
+        messages.put(None)
+
+
+def get_resize_grid(dst_start, dst_end, scale, src_start, src_length, device):
+    """Return normalized grid_sample coordinates that reproduce a bilinear resize (align_corners=False) over a window of the source"""
+    dst = torch.arange(dst_start, dst_end, device=device, dtype=torch.float32)
+    src = ((dst + 0.5) * scale - 0.5).clamp(min=0) - src_start
+    return (src + 0.5) * 2.0 / src_length - 1.0
+
+
+def upscale_mask_region(predictor, low_res_mask, box):
+    """Upscale the part of a low resolution mask within a box (x1, y1, x2, y2) to the original image size"""
+    x1, y1, x2, y2 = [int(v) for v in box]
+    orig_h, orig_w = predictor.original_size
+    input_h, input_w = predictor.input_size
+    img_size = predictor.model.image_encoder.img_size
+    low_res_size = low_res_mask.shape[-1]
+    device = low_res_mask.device
+
+    # Sam.postprocess_masks resizes the low res mask to the padded input size, crops the padding, then resizes to
+    # the original size; do the same two resizes, but only for the input pixels the box needs
+    scale_x = input_w / orig_w
+    scale_y = input_h / orig_h
+    in_x1 = max(0, int((x1 + 0.5) * scale_x - 0.5) - 1)
+    in_y1 = max(0, int((y1 + 0.5) * scale_y - 0.5) - 1)
+    in_x2 = min(input_w, int((x2 - 0.5) * scale_x - 0.5) + 2)
+    in_y2 = min(input_h, int((y2 - 0.5) * scale_y - 0.5) + 2)
+
+    # Low res mask to the input pixels
+    grid_x = get_resize_grid(
+        in_x1, in_x2, low_res_size / img_size, 0, low_res_size, device
+    )
+    grid_y = get_resize_grid(
+        in_y1, in_y2, low_res_size / img_size, 0, low_res_size, device
+    )
+    grid = torch.stack(torch.meshgrid(grid_y, grid_x, indexing="ij")[::-1], dim=-1)
+    input_mask = F.grid_sample(
+        low_res_mask[None].float(),
+        grid[None],
+        mode="bilinear",
+        padding_mode="border",
+        align_corners=False,
+    )
+
+    # Input pixels to the original pixels in the box
+    grid_x = get_resize_grid(x1, x2, scale_x, in_x1, in_x2 - in_x1, device)
+    grid_y = get_resize_grid(y1, y2, scale_y, in_y1, in_y2 - in_y1, device)
+    grid = torch.stack(torch.meshgrid(grid_y, grid_x, indexing="ij")[::-1], dim=-1)
+    mask = F.grid_sample(
+        input_mask,
+        grid[None],
+        mode="bilinear",
+        padding_mode="border",
+        align_corners=False,
+    )
+
+    return (mask[0, 0] > predictor.model.mask_threshold).cpu().numpy()
+
+
+def xywh_to_xyxy(bbox):
+    """Convert a box from (x, y, width, height) to (x1, y1, x2, y2)"""
+    x, y, w, h = [int(v) for v in bbox]
+    return (x, y, x + w, y + h)
@@ -0,0 +1,186 @@
+"""Utility functions for finding text in images"""
+
+import threading
+
+import cv2
+from PIL import Image
+
+# OCR backends are optional; tesserocr runs tesseract in-process, pytesseract shells out to the tesseract binary
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+# Each thread needs its own tesseract API instance
+TESSEROCR_THREAD_DATA = threading.local()
+
+# If there are more candidate text regions than this, OCR their combined bounding box once instead
+MAX_TEXT_REGIONS = 8
+
+
+def find_text_boxes(image, min_text_dimension=0, backend="auto", ocr_text_size=48):
+    """Return the symbol boxes (symbol, x1, y1, x2, y2) in an RGB image, running OCR on a downscaled copy"""
+    backend = get_ocr_backend(backend)
+    im_h, im_w, _ = image.shape
+
+    # Downscale so the smallest text we care about is still ocr_text_size pixels
+    scale = 1.0
+    if min_text_dimension > ocr_text_size:
+        scale = 1.0 * ocr_text_size / min_text_dimension
+    ocr_image = image
+    if scale < 1.0:
+        ocr_image = cv2.resize(
+            image,
+            (max(1, round(im_w * scale)), max(1, round(im_h * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+
+    # Only run OCR on regions that could contain text that is large enough
+    regions = get_text_regions(ocr_image, min_text_dimension * scale)
+    if backend == "tesserocr":
+        boxes = get_boxes_tesserocr(ocr_image, regions)
+    else:
+        boxes = get_boxes_pytesseract(ocr_image, regions)
+
+    # Scale the boxes back to the original image
+    if scale < 1.0:
+        boxes = [
+            (
+                symbol,
+                max(0, int(x1 / scale)),
+                max(0, int(y1 / scale)),
+                min(im_w, int(round(x2 / scale))),
+                min(im_h, int(round(y2 / scale))),
+            )
+            for symbol, x1, y1, x2, y2 in boxes
+        ]
+    return boxes
+
+
+def get_boxes_pytesseract(image, regions):
+    """Return the symbol boxes in regions (x1, y1, x2, y2) of an image using the tesseract binary"""
+    boxes = []
+    for x1, y1, x2, y2 in regions:
+        region_h = y2 - y1
+        lines = pytesseract.image_to_boxes(image[y1:y2, x1:x2]).splitlines()
+        for b in [line.split(" ") for line in lines]:
+            # put into format (symbol, x1, y1, x2, y2)
+            boxes.append(
+                (
+                    b[0],
+                    x1 + int(b[1]),
+                    y1 + region_h - int(b[4]),
+                    x1 + int(b[3]),
+                    y1 + region_h - int(b[2]),
+                )
+            )
+    return boxes
+
+
+def get_boxes_tesserocr(image, regions):
+    """Return the symbol boxes in regions (x1, y1, x2, y2) of an image using the in-process tesseract API"""
+    if not hasattr(TESSEROCR_THREAD_DATA, "api"):
+        TESSEROCR_THREAD_DATA.api = tesserocr.PyTessBaseAPI()
+    api = TESSEROCR_THREAD_DATA.api
+    api.SetImage(Image.fromarray(image))
+
+    boxes = []
+    for x1, y1, x2, y2 in regions:
+        api.SetRectangle(x1, y1, x2 - x1, y2 - y1)
+        api.Recognize()
+        iterator = api.GetIterator()
+        if iterator is None:
+            continue
+        # Boxes are returned in the coordinates of the full image
+        for result in tesserocr.iterate_level(iterator, tesserocr.RIL.SYMBOL):
+            symbol = result.GetUTF8Text(tesserocr.RIL.SYMBOL)
+            bbox = result.BoundingBox(tesserocr.RIL.SYMBOL)
+            if symbol is None or bbox is None:
+                continue
+            boxes.append((symbol.strip(), *bbox))
+    return boxes
+
+
+def get_ocr_backend(backend="auto"):
+    """Return the name of an available OCR backend, preferring the in-process one"""
+    if backend == "auto":
+        backend = "tesserocr" if tesserocr is not None else "pytesseract"
+    if backend == "tesserocr" and tesserocr is None:
+        raise ImportError("tesserocr is not installed; run: pip install tesserocr")
+    if backend == "pytesseract" and pytesseract is None:
+        raise ImportError("pytesseract is not installed; run: pip install pytesseract")
+    if backend not in ["tesserocr", "pytesseract"]:
+        raise ValueError(f"Unknown OCR backend: {backend}")
+    return backend
+
+
+def get_text_regions(image, min_text_dimension=0):
+    """Return regions (x1, y1, x2, y2) of an RGB image that are large enough to contain text of a min dimension"""
+    im_h, im_w, _ = image.shape
+    full_region = (0, 0, im_w, im_h)
+    if min_text_dimension <= 1:
+        return [full_region]
+
+    # Join the edges of neighboring symbols into blobs
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    edges = cv2.Canny(gray, 50, 150)
+    kernel_size = max(3, int(min_text_dimension / 4))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    blobs = cv2.dilate(edges, kernel)
+
+    # A blob smaller than the min text dimension cannot contain a symbol that large
+    _, _, stats, _ = cv2.connectedComponentsWithStats(blobs, connectivity=8)
+    margin = kernel_size
+    regions = []
+    for x, y, w, h, _ in stats[1:].tolist():
+        if max(w, h) < min_text_dimension:
+            continue
+        regions.append(
+            (
+                max(0, x - margin),
+                max(0, y - margin),
+                min(im_w, x + w + margin),
+                min(im_h, y + h + margin),
+            )
+        )
+
+    regions = merge_overlapping_regions(regions)
+    if len(regions) > MAX_TEXT_REGIONS:
+        regions = [
+            (
+                min(r[0] for r in regions),
+                min(r[1] for r in regions),
+                max(r[2] for r in regions),
+                max(r[3] for r in regions),
+            )
+        ]
+    return regions
+
+
+def merge_overlapping_regions(regions):
+    """Merge regions (x1, y1, x2, y2) that overlap so no part of the image is read twice"""
+    regions = list(regions)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a = regions[i]
+                b = regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = (
+                        min(a[0], b[0]),
+                        min(a[1], b[1]),
+                        max(a[2], b[2]),
+                        max(a[3], b[3]),
+                    )
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
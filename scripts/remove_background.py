@@ -7,10 +7,11 @@ import os
 
 import cv2
 import numpy as np
-from segment_anything import SamPredictor, sam_model_registry
+from segment_anything import sam_model_registry
 from segment_anything.utils.transforms import ResizeLongestSide
 import torch
 
+from model_utilities import *
 from utilities import *
 
 
@@ -41,12 +42,38 @@ def parse_args():
         default=4096,
         help="Max dimension of a source image; image will be resized before processing",
     )
+    parser.add_argument(
+        "-embcache",
+        dest="EMBEDDING_CACHE_DIRECTORY",
+        default="",
+        help="Directory to cache image embeddings in so re-runs can skip the image encoder; leave blank to disable",
+    )
+    parser.add_argument(
+        "-embcachesize",
+        dest="EMBEDDING_CACHE_SIZE",
+        type=float,
+        default=10.0,
+        help="Max size of the image embedding cache in gigabytes",
+    )
+    parser.add_argument(
+        "-procs",
+        dest="PROCESSES",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard the images across; each needs its own memory for the model's activations, so N processes need about N times the peak memory of one",
+    )
     parser.add_argument(
         "-clean",
         dest="CLEAN",
         action="store_true",
         help="Clear the output directory before processing?",
     )
+    parser.add_argument(
+        "-retry-failed",
+        dest="RETRY_FAILED",
+        action="store_true",
+        help="Retry images that failed in a previous run",
+    )
     parser.add_argument(
         "-debug",
         dest="DEBUG",
@@ -124,6 +151,101 @@ def do_prediction(predictor, image=False, bbox=None, mask=None, reset=False):
     return masks
 
 
+def read_file(context, job):
+    """Read an image along with its embedding if it was cached"""
+    a = context["a"]
+    embedding_cache = context["embedding_cache"]
+    i, fn = job
+
+    image = load_image(fn, a.MAX_IMAGE_DIMENSION)
+    embedding_key = None
+    embedding = None
+    if image is not None and embedding_cache is not None:
+        embedding_key = embedding_cache.get_key(fn, a.MODEL, a.MAX_IMAGE_DIMENSION)
+        embedding = embedding_cache.get(embedding_key)
+
+    return image, embedding_key, embedding
+
+
+def remove_background(context, job, data, report):
+    """Find the largest foreground segment of an image"""
+    predictor = context["predictor"]
+    embedding_cache = context["embedding_cache"]
+    manifest = context["manifest"]
+    file_count = context["file_count"]
+    i, fn = job
+    image, embedding_key, embedding = data
+
+    report(f"Processing {i+1} of {file_count}: {fn}")
+    if image is None:
+        report(f"Could not read file {fn}; skipping")
+        manifest.record(fn, "failed", reason="Could not read file")
+        return None
+    im_h, im_w, _ = image.shape
+
+    # Set the image embedding, loading it from the cache if possible
+    if embedding is None:
+        try:
+            embedding = get_embedding(predictor, image, embedding_cache, embedding_key)
+        except RuntimeError as error:
+            report(f"Error with segmentation: {error}")
+            manifest.record(fn, "failed", reason=str(error))
+            return None
+    predictor.set_embedding(embedding)
+
+    # Do prediction
+    masks = do_prediction(predictor, bbox=[0, 0, im_w, im_h])
+    if len(masks) == 0:
+        manifest.record(fn, "failed", reason="No mask predicted")
+        return None
+
+    # Assume the mask is the background, so invert it to get the foreground
+    mask = masks[0]
+    mask = np.bitwise_not(mask)
+
+    # Convert to int
+    segment_mask = mask.astype(np.uint8)
+    segment_mask *= 255
+
+    # Get the largest segment
+    largest_segment = get_largest_mask_segment(segment_mask)
+    if largest_segment is None:
+        manifest.record(fn, "skipped", reason="No foreground found")
+        return None
+
+    return image, largest_segment
+
+
+def write_file(context, job, result):
+    """Write the largest foreground segment of an image to file"""
+    if result is None:
+        return
+    a = context["a"]
+    i, fn = job
+    image, largest_segment = result
+
+    # Crop and mask the image
+    cropped_image = extract_segment(
+        image, largest_segment["mask"], largest_segment["bbox"]
+    )
+
+    segment_fn = f"{a.OUTPUT_DIR}/{get_basename(fn)}.png"
+    cv2.imwrite(segment_fn, cropped_image)
+    context["manifest"].record(fn, "processed", [segment_fn])
+
+
+def remove_backgrounds(context, files, report):
+    """Remove the background of a list of (index, filename) pairs and write the results to file"""
+
+    # Read the next image and write the previous one while the model runs
+    run_pipeline(
+        files,
+        lambda job: read_file(context, job),
+        lambda job, data: remove_background(context, job, data, report),
+        lambda job, result: write_file(context, job, result),
+    )
+
+
 def main(a):
     """Main function to segment a directory of images"""
 
@@ -145,59 +267,40 @@ def main(a):
         print("CUDA is available")
         sam.to(device="cuda")
 
-    predictor = SamPredictor(sam)
+    predictor = EmbeddingPredictor(sam)
+    embedding_cache = get_embedding_cache(
+        a.EMBEDDING_CACHE_DIRECTORY, a.EMBEDDING_CACHE_SIZE
+    )
+
+    # Images are re-processed if any of the parameters that affect the output change
+    manifest = RunManifest(
+        os.path.join(a.OUTPUT_DIR, "manifest.db"),
+        {"MODEL": a.MODEL, "MAX_IMAGE_DIMENSION": a.MAX_IMAGE_DIMENSION},
+    )
 
+    # Queue up the files that have not been processed yet
+    pending = []
     for i, fn in enumerate(filenames):
         existsFn = f"{a.OUTPUT_DIR}/{get_basename(fn)}.png"
-        if os.path.isfile(existsFn):
+        if manifest.is_done(fn, a.RETRY_FAILED, existsFn, commit=False):
             print(f"Already processed {i+1} of {file_count}: {fn}")
             continue
-        print(f"Processing {i+1} of {file_count}: {fn}")
-
-        image = cv2.imread(fn)
-        im_h, im_w, im_c = image.shape
-        im_d = max(im_h, im_w)
-
-        # Resize if necessary
-        if im_d > a.MAX_IMAGE_DIMENSION:
-            scale = 1.0 * a.MAX_IMAGE_DIMENSION / im_d
-            im_h = round_int(im_h * scale)
-            im_w = round_int(im_w * scale)
-            image = cv2.resize(image, (im_w, im_h))
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        # Do prediction
-        masks = do_prediction(predictor, image, bbox=[0, 0, im_w, im_h], reset=i > 0)
-        if len(masks) == 0:
-            continue
-
-        # Assume the mask is the background, so invert it to get the foreground
-        mask = masks[0]
-        mask = np.bitwise_not(mask)
-
-        # Add transparency
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGRA)
-
-        # Convert to int
-        segment_mask = mask.astype(np.uint8)
-        segment_mask *= 255
-
-        # Get the largest segment
-        largest_segment = get_largest_mask_segment(segment_mask)
-
-        # Mask the image
-        masked_image = cv2.bitwise_and(
-            image, image, mask=largest_segment["mask"].astype(np.uint8)
-        )
-
-        # Crop the image
-        x, y, w, h = tuple(largest_segment["bbox"])
-        x2 = x + w
-        y2 = y + h
-        cropped_image = masked_image[y:y2, x:x2]
-
-        segment_fn = f"{a.OUTPUT_DIR}/{get_basename(fn)}.png"
-        cv2.imwrite(segment_fn, cropped_image)
+        pending.append((i, fn))
+    manifest.commit()
+
+    # Workers share the model's weights instead of each loading a copy
+    if a.PROCESSES > 1:
+        sam.share_memory()
+
+    context = {
+        "a": a,
+        "predictor": predictor,
+        "embedding_cache": embedding_cache,
+        "manifest": manifest,
+        "file_count": file_count,
+    }
+    process_files(pending, remove_backgrounds, context, a.PROCESSES)
+    manifest.close()
 
 
 main(parse_args())
@@ -4,13 +4,15 @@
 
 import argparse
 import os
+import time
 
 import cv2
 import numpy as np
-import pytesseract
-from segment_anything import SamPredictor, sam_model_registry
+from segment_anything import sam_model_registry
 import torch
 
+from model_utilities import *
+from ocr_utilities import *
 from utilities import *
 
 
@@ -42,18 +44,64 @@ def parse_args():
         default=200,
         help="Only segment text that has a dimension of this value or higher",
     )
+    parser.add_argument(
+        "-ocr",
+        dest="OCR_BACKEND",
+        default="auto",
+        help="OCR backend: tesserocr (in-process), pytesseract (tesseract binary), or auto (tesserocr if installed)",
+    )
+    parser.add_argument(
+        "-ocrsize",
+        dest="OCR_TEXT_SIZE",
+        type=int,
+        default=48,
+        help="Downscale images for OCR so text of the min text dimension is this many pixels",
+    )
+    parser.add_argument(
+        "-ocrworkers",
+        dest="OCR_WORKERS",
+        type=int,
+        default=2,
+        help="Number of images to read and run OCR on ahead of segmentation",
+    )
+    parser.add_argument(
+        "-boxbatch",
+        dest="BOX_BATCH_SIZE",
+        type=int,
+        default=64,
+        help="Number of symbol bounding boxes to decode masks for at the same time",
+    )
     parser.add_argument(
         "-out",
         dest="OUTPUT_DIR",
         default="output/sample-text-segments/",
         help="Output directory",
     )
+    parser.add_argument(
+        "-embcache",
+        dest="EMBEDDING_CACHE_DIRECTORY",
+        default="",
+        help="Directory to cache image embeddings in so re-runs can skip the image encoder; leave blank to disable",
+    )
+    parser.add_argument(
+        "-embcachesize",
+        dest="EMBEDDING_CACHE_SIZE",
+        type=float,
+        default=10.0,
+        help="Max size of the image embedding cache in gigabytes",
+    )
     parser.add_argument(
         "-clean",
         dest="CLEAN",
         action="store_true",
         help="Clear the output directory before processing?",
     )
+    parser.add_argument(
+        "-retry-failed",
+        dest="RETRY_FAILED",
+        action="store_true",
+        help="Retry images that failed in a previous run",
+    )
     parser.add_argument(
         "-debug",
         dest="DEBUG",
@@ -78,6 +126,133 @@ def show_boxes(image, boxes):
     cv2.waitKey(0)
 
 
+def read_file(context, job):
+    """Read an image, find its text, and load its embedding if it was cached"""
+    a = context["a"]
+    embedding_cache = context["embedding_cache"]
+    i, fn = job
+
+    image = load_image(fn, a.MAX_IMAGE_DIMENSION)
+    if image is None:
+        return None
+
+    # Do OCR
+    start_time = time.perf_counter()
+    boxes = find_text_boxes(image, a.MIN_TEXT_DIMENSION, a.OCR_BACKEND, a.OCR_TEXT_SIZE)
+    ocr_time = time.perf_counter() - start_time
+
+    embedding_key = None
+    embedding = None
+    if embedding_cache is not None:
+        embedding_key = embedding_cache.get_key(fn, a.MODEL, a.MAX_IMAGE_DIMENSION)
+        embedding = embedding_cache.get(embedding_key)
+
+    return image, boxes, ocr_time, embedding_key, embedding
+
+
+def segment_text(context, job, data):
+    """Segment each symbol that OCR found in an image"""
+    a = context["a"]
+    predictor = context["predictor"]
+    embedding_cache = context["embedding_cache"]
+    manifest = context["manifest"]
+    file_count = context["file_count"]
+    i, fn = job
+
+    print(f"Processing {i+1} of {file_count}: {fn}")
+    if data is None:
+        print(f"Could not read file {fn}; skipping")
+        manifest.record(fn, "failed", reason="Could not read file")
+        return None
+    image, boxes, ocr_time, embedding_key, embedding = data
+
+    # Show bounding boxes if debug
+    if a.DEBUG:
+        show_boxes(image, boxes)
+        return None
+
+    # Only segment alpha numeric symbols that are large enough
+    symbols = []
+    for bbox in boxes:
+        symbol, x1, y1, x2, y2 = bbox
+
+        # only process alpha numeric symbols
+        if not symbol.isalnum():
+            continue
+
+        # only process text that is large enough
+        tw = x2 - x1
+        th = y2 - y1
+        max_text_dimension = max(tw, th)
+        if max_text_dimension < a.MIN_TEXT_DIMENSION or min(tw, th) <= 0:
+            continue
+
+        symbols.append(bbox)
+
+    segments = []
+    if len(symbols) == 0:
+        print(f"No symbols found in {fn}. OCR: {ocr_time:.2f}s")
+        manifest.record(fn, "skipped", reason="No symbols found")
+        return None
+
+    # Decode a mask for every symbol's bounding box in batches
+    start_time = time.perf_counter()
+    try:
+        # Set the image embedding, loading it from the cache if possible
+        if embedding is None:
+            embedding = get_embedding(predictor, image, embedding_cache, embedding_key)
+        predictor.set_embedding(embedding)
+        masks = predict_box_masks(
+            predictor,
+            [(x1, y1, x2, y2) for _, x1, y1, x2, y2 in symbols],
+            a.BOX_BATCH_SIZE,
+        )
+    except RuntimeError as error:
+        print(f"Error with segmentation: {error}")
+        manifest.record(fn, "failed", reason=str(error))
+        return None
+    segmentation_time = time.perf_counter() - start_time
+
+    # Masks are already cropped to each symbol's bounding box
+    for (symbol, x1, y1, x2, y2), mask in zip(symbols, masks):
+        segments.append((symbol, (x1, y1, x2, y2), mask))
+
+    print(
+        f"Segmented {len(segments)} symbols in {fn}. OCR: {ocr_time:.2f}s, segmentation: {segmentation_time:.2f}s"
+    )
+    return image, segments
+
+
+def write_segments(context, job, result):
+    """Write each symbol segment of an image to file"""
+    if result is None:
+        return
+    a = context["a"]
+    i, fn = job
+    image, segments = result
+
+    counts = {}
+    segment_fns = []
+    for symbol, (x1, y1, x2, y2), mask in segments:
+        # Crop and mask the image
+        cropped_image = extract_segment(image, mask, (x1, y1, x2 - x1, y2 - y1))
+
+        # Write the image to file
+        if symbol not in counts:
+            counts[symbol] = 0
+        counts[symbol] += 1
+        count = counts[symbol]
+        segment_fn = f"{a.OUTPUT_DIR}{symbol.lower()}/{get_basename(fn)}-{count}.png"
+        make_directories(segment_fn)
+        try:
+            cv2.imwrite(segment_fn, cropped_image)
+            segment_fns.append(segment_fn)
+        except cv2.error as e:
+            print(f"Error writing image to file: {e}")
+
+    context["manifest"].record(fn, "processed", segment_fns)
+
+
 def main(a):
     """Main function to segment a directory of images"""
 
@@ -94,110 +269,72 @@ def main(a):
     file_count = len(filenames)
     print(f"{file_count} files found.")
 
+    # Make sure the OCR backend is installed before loading the model
+    print(f"Using OCR backend: {get_ocr_backend(a.OCR_BACKEND)}")
+
     sam = sam_model_registry[a.MODEL](checkpoint=a.MODEL_CHECKPOINT)
     if torch.cuda.is_available():
         print("CUDA is available")
         sam.to(device="cuda")
 
-    predictor = SamPredictor(sam)
+    predictor = EmbeddingPredictor(sam)
+    embedding_cache = get_embedding_cache(
+        a.EMBEDDING_CACHE_DIRECTORY, a.EMBEDDING_CACHE_SIZE
+    )
+
+    # Images are re-processed if any of the parameters that affect the output change
+    manifest = RunManifest(
+        os.path.join(a.OUTPUT_DIR, "manifest.db"),
+        {
+            "MODEL": a.MODEL,
+            "MAX_IMAGE_DIMENSION": a.MAX_IMAGE_DIMENSION,
+            "MIN_TEXT_DIMENSION": a.MIN_TEXT_DIMENSION,
+            "OCR_TEXT_SIZE": a.OCR_TEXT_SIZE,
+        },
+    )
+
+    # Index the outputs of runs from before there was a manifest with a single scan
+    existing_outputs = {}
+    if len(manifest) == 0:
+        for segment_fn in get_filenames(f"{a.OUTPUT_DIR}/*/*.png"):
+            basename = get_basename(segment_fn).rsplit("-", 1)[0]
+            existing_outputs.setdefault(basename, []).append(segment_fn)
 
+    # Queue up the files that have not been processed yet
+    pending = []
     for i, fn in enumerate(filenames):
-        existing_files = get_filenames(f"{a.OUTPUT_DIR}/**/{get_basename(fn)}-*.png")
-        if len(existing_files) > 0:
+        basename = get_basename(fn)
+        if basename in existing_outputs:
+            manifest.record(fn, "processed", existing_outputs[basename], commit=False)
+        if manifest.is_done(fn, a.RETRY_FAILED):
             print(f"Already processed {i+1} of {file_count}: {fn}")
             continue
-        print(f"Processing {i+1} of {file_count}: {fn}")
-
-        image = cv2.imread(fn)
-        im_h, im_w, im_c = image.shape
-        im_d = max(im_h, im_w)
-
-        # Resize if necessary
-        if im_d > a.MAX_IMAGE_DIMENSION:
-            scale = 1.0 * a.MAX_IMAGE_DIMENSION / im_d
-            im_h = round_int(im_h * scale)
-            im_w = round_int(im_w * scale)
-            image = cv2.resize(image, (im_w, im_h))
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        # Do OCR
-        boxes = pytesseract.image_to_boxes(image)
-        # print(boxes)
-        boxes = [line.split(" ") for line in boxes.splitlines()]
-        # put into format (symbol, x1, y1, x2, y2)
-        boxes = [
-            (b[0], int(b[1]), im_h - int(b[4]), int(b[3]), im_h - int(b[2]))
-            for b in boxes
-        ]
-
-        # Show bounding boxes if debug
-        if a.DEBUG:
-            show_boxes(image, boxes)
-            break
-
-        # Add transparency
-        image_rgba = cv2.cvtColor(image, cv2.COLOR_RGB2BGRA)
-
-        # Do segmentation for each symbol
-        is_first = True
-        counts = {}
-        for bbox in boxes:
-            symbol, x1, y1, x2, y2 = bbox
-            masks = []
-
-            # only process alpha numeric symbols
-            if not symbol.isalnum():
-                continue
-
-            # only process text that is large enough
-            tw = x2 - x1
-            th = y2 - y1
-            max_text_dimension = max(tw, th)
-            if max_text_dimension < a.MIN_TEXT_DIMENSION:
-                continue
-
-            # Do the prediction with the symbol's bounding box
-            try:
-                if is_first:
-                    predictor.reset_image()
-                    predictor.set_image(image)
-                    is_first = False
-
-                input_box = np.array([x1, y1, x2, y2])[None, :]
-                masks, _, _ = predictor.predict(
-                    point_coords=None,
-                    point_labels=None,
-                    box=input_box,
-                    multimask_output=False,
-                )
-            except RuntimeError as error:
-                print(f"Error with segmentation: {error}")
-
-            if len(masks) == 0:
-                continue
-
-            # Convert mask to int
-            mask = masks[0]
-            segment_mask = mask.astype(np.uint8)
-            segment_mask *= 255
-
-            # Mask and crop the image
-            masked_image = cv2.bitwise_and(image_rgba, image_rgba, mask=segment_mask)
-            cropped_image = masked_image[y1:y2, x1:x2]
-
-            # Write the image to file
-            if symbol not in counts:
-                counts[symbol] = 0
-            counts[symbol] += 1
-            count = counts[symbol]
-            segment_fn = (
-                f"{a.OUTPUT_DIR}{symbol.lower()}/{get_basename(fn)}-{count}.png"
-            )
-            make_directories(segment_fn)
-            try:
-                cv2.imwrite(segment_fn, cropped_image)
-            except cv2.error as e:
-                print(f"Error writing image to file: {e}")
+        pending.append((i, fn))
+    manifest.commit()
+
+    # Only show the bounding boxes of the first image if debug
+    if a.DEBUG:
+        pending = pending[:1]
+
+    context = {
+        "a": a,
+        "predictor": predictor,
+        "embedding_cache": embedding_cache,
+        "manifest": manifest,
+        "file_count": file_count,
+    }
+
+    # Read and run OCR on the next images and write the previous one while the model runs
+    ocr_workers = max(1, a.OCR_WORKERS)
+    run_pipeline(
+        pending,
+        lambda job: read_file(context, job),
+        lambda job, data: segment_text(context, job, data),
+        lambda job, result: write_segments(context, job, result),
+        queue_size=ocr_workers,
+        readers=ocr_workers,
+    )
+    manifest.close()
 
 
 main(parse_args())
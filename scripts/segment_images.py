@@ -10,6 +10,7 @@ import numpy as np
 from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
 import torch
 
+from model_utilities import *
 from utilities import *
 
 
@@ -47,6 +48,40 @@ def parse_args():
         default=4000,
         help="Max dimension of a source image; image will be resized before processing",
     )
+    parser.add_argument(
+        "-prompt",
+        dest="PROMPT",
+        default="auto",
+        help="How to prompt SAM for masks; values: auto (a grid of points over the whole image), detector (the boxes of objects Mask R-CNN detects)",
+    )
+    parser.add_argument(
+        "-detthreshold",
+        dest="DETECTOR_THRESHOLD",
+        type=float,
+        default=0.5,
+        help="Min detection score for a box to be used as a prompt with -prompt detector (0-1)",
+    )
+    parser.add_argument(
+        "-boxbatch",
+        dest="BOX_BATCH_SIZE",
+        type=int,
+        default=64,
+        help="Number of detected boxes to decode masks for at the same time",
+    )
+    parser.add_argument(
+        "-tile",
+        dest="TILE_SIZE",
+        type=int,
+        default=0,
+        help="Generate masks tile by tile for images larger than this; use with -maxd 0 to segment at full resolution; 0 to disable",
+    )
+    parser.add_argument(
+        "-overlap",
+        dest="TILE_OVERLAP",
+        type=int,
+        default=256,
+        help="Number of pixels that neighboring tiles overlap",
+    )
     parser.add_argument(
         "-edge",
         dest="EDGE",
@@ -66,12 +101,45 @@ def parse_args():
         default="",
         help="Output a single composite of the largest segment; values: bbox (all segments that are within that segment's bounding box), all (all remaining segments)",
     )
+    parser.add_argument(
+        "-batch",
+        dest="BATCH_SIZE",
+        type=int,
+        default=1,
+        help="Number of images to run through the image encoder at the same time",
+    )
+    parser.add_argument(
+        "-embcache",
+        dest="EMBEDDING_CACHE_DIRECTORY",
+        default="",
+        help="Directory to cache image embeddings in so re-runs can skip the image encoder; leave blank to disable",
+    )
+    parser.add_argument(
+        "-embcachesize",
+        dest="EMBEDDING_CACHE_SIZE",
+        type=float,
+        default=10.0,
+        help="Max size of the image embedding cache in gigabytes",
+    )
+    parser.add_argument(
+        "-procs",
+        dest="PROCESSES",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard the images across; each needs its own memory for the model's activations, so N processes need about N times the peak memory of one",
+    )
     parser.add_argument(
         "-clean",
         dest="CLEAN",
         action="store_true",
         help="Clear the output directory before processing?",
     )
+    parser.add_argument(
+        "-retry-failed",
+        dest="RETRY_FAILED",
+        action="store_true",
+        help="Retry images that failed in a previous run",
+    )
     parser.add_argument(
         "-debug",
         dest="DEBUG",
@@ -82,6 +150,230 @@ def parse_args():
     return args
 
 
+def is_tiled(a, image):
+    """Check if an image should be segmented in tiles"""
+    # Box prompts are decoded from a single embedding of the whole image
+    if a.PROMPT == "detector":
+        return False
+    return a.TILE_SIZE > 0 and max(image.shape[:2]) > a.TILE_SIZE
+
+
+def save_segments(a, fn, image, masks):
+    """Filter the masks of an image, write the remaining segments to file, and return their filenames"""
+    im_h, im_w, _ = image.shape
+
+    if len(masks) == 0:
+        return []
+    if a.REMOVE_LARGEST and len(masks) > 1:
+        # remove the mask with the largest bounding box (which should be the background)
+        masks = sorted(masks, key=lambda x: x["bbox"][2] * x["bbox"][3], reverse=True)
+        masks = masks[1:]
+    # sort by area
+    masks = sorted(masks, key=(lambda x: x["area"]), reverse=True)
+
+    # remove masks that are on the edge
+    non_edge_masks = []
+    for mask in masks:
+        edge = max(1, im_h * a.EDGE, im_w * a.EDGE)
+        x, y, w, h = tuple(mask["bbox"])
+        x2 = x + w
+        y2 = y + h
+        if x > edge and y > edge and x2 < (im_w - edge) and y2 < (im_h - edge):
+            non_edge_masks.append(mask)
+    masks = non_edge_masks
+    if len(masks) == 0:
+        return []
+
+    # If this is a composite
+    if a.COMPOSITE != "" and len(masks) > 1:
+        largest_mask = masks[0]
+        remainder = masks[1:]
+
+        # Merge the largest segment with all segments that are within it's bounding box
+        composite_masks = [largest_mask]
+        for mask in remainder:
+            if a.COMPOSITE == "all" or bbox_contains(
+                tuple(largest_mask["bbox"]), tuple(mask["bbox"])
+            ):
+                composite_masks.append(mask)
+
+        masks = [merge_compact_masks(composite_masks)]
+
+    else:
+        sample_size = a.MAX_SEGMENTS
+        if len(masks) > sample_size:
+            masks = masks[:sample_size]
+
+    segment_fns = []
+    for j, mask in enumerate(masks):
+        basename = f"{get_basename(fn)}-{j+1}" if j > 0 else get_basename(fn)
+        segment_fn = f"{a.OUTPUT_DIR}/{basename}.png"
+        x, y, w, h = tuple(mask["bbox"])
+        if x is None or y is None or w is None or h is None:
+            continue
+        x = int(x)
+        y = int(y)
+        w = int(w)
+        h = int(h)
+        cropped_image = extract_segment(image, mask["segmentation"], (x, y, w, h))
+        cv2.imwrite(segment_fn, cropped_image)
+        segment_fns.append(segment_fn)
+
+    return segment_fns
+
+
+def predict_detected_masks(predictor, instances, box_batch_size):
+    """Decode a SAM mask for the box of each detected instance, returning compact masks"""
+    boxes = [xywh_to_xyxy(instance["bbox"]) for instance in instances]
+    masks = []
+    for (x1, y1, x2, y2), segmentation in zip(
+        boxes, predict_box_masks(predictor, boxes, box_batch_size)
+    ):
+        area = int(np.count_nonzero(segmentation))
+        if area == 0:
+            continue
+        masks.append(
+            {
+                "segmentation": segmentation,
+                "bbox": [x1, y1, x2 - x1, y2 - y1],
+                "area": area,
+            }
+        )
+    return masks
+
+
+def read_batch(context, batch):
+    """Read a batch of images along with any of their embeddings that were cached"""
+    a = context["a"]
+    embedding_cache = context["embedding_cache"]
+
+    images = [load_image(fn, a.MAX_IMAGE_DIMENSION) for _, fn in batch]
+    embedding_keys = [None] * len(batch)
+    embeddings = [None] * len(batch)
+    if embedding_cache is not None:
+        embedding_keys = [
+            embedding_cache.get_key(fn, a.MODEL, a.MAX_IMAGE_DIMENSION)
+            for _, fn in batch
+        ]
+        embeddings = [embedding_cache.get(key) for key in embedding_keys]
+
+    return images, embedding_keys, embeddings
+
+
+def segment_batch(context, batch, data, report):
+    """Generate the masks for a batch of images"""
+    a = context["a"]
+    sam = context["sam"]
+    mask_generator = context["mask_generator"]
+    detector = context["detector"]
+    embedding_cache = context["embedding_cache"]
+    manifest = context["manifest"]
+    file_count = context["file_count"]
+    images, embedding_keys, embeddings = data
+
+    # Find the boxes to prompt SAM with for the whole batch at once
+    detections = [None] * len(batch)
+    readable = [j for j, image in enumerate(images) if image is not None]
+    if detector is not None and len(readable) > 0:
+        try:
+            for j, instances in zip(
+                readable, detect_instances(detector, [images[j] for j in readable])
+            ):
+                detections[j] = instances
+        except RuntimeError as error:
+            report(f"Error detecting batch; detecting images one at a time: {error}")
+
+    # Run the image encoder on the images without cached embeddings all at once
+    uncached = [
+        j
+        for j, image in enumerate(images)
+        if image is not None and embeddings[j] is None and not is_tiled(a, image)
+    ]
+    if len(batch) > 1 and len(uncached) > 0:
+        try:
+            encoded = encode_images(sam, [images[j] for j in uncached])
+            for j, embedding in zip(uncached, encoded):
+                embeddings[j] = embedding
+                if embedding_cache is not None:
+                    embedding_cache.put(embedding_keys[j], embedding)
+        except RuntimeError as error:
+            report(f"Error encoding batch; encoding images one at a time: {error}")
+
+    results = []
+    for j, (i, fn) in enumerate(batch):
+        report(f"Processing {i+1} of {file_count}: {fn}")
+        image = images[j]
+        if image is None:
+            report(f"Could not read file {fn}; skipping")
+            manifest.record(fn, "failed", reason="Could not read file")
+            continue
+
+        try:
+            # Large images are segmented in tiles to keep memory bounded
+            if is_tiled(a, image):
+                masks = generate_tiled_masks(
+                    mask_generator, image, a.TILE_SIZE, a.TILE_OVERLAP
+                )
+            else:
+                embedding = embeddings[j]
+                if embedding is None:
+                    embedding = get_embedding(
+                        mask_generator.predictor,
+                        image,
+                        embedding_cache,
+                        embedding_keys[j],
+                    )
+                mask_generator.predictor.set_embedding(embedding)
+                if detector is not None:
+                    if detections[j] is None:
+                        detections[j] = detect_instances(detector, [image])[0]
+                    masks = predict_detected_masks(
+                        mask_generator.predictor,
+                        detections[j],
+                        a.BOX_BATCH_SIZE,
+                    )
+                else:
+                    masks = [
+                        compact_mask(mask) for mask in mask_generator.generate(image)
+                    ]
+        except RuntimeError as error:
+            report(f"Error with file {fn}; skipping: {error}")
+            manifest.record(fn, "failed", reason=str(error))
+            continue
+
+        results.append((fn, image, masks))
+
+    return results
+
+
+def write_batch(context, results):
+    """Write the segments of a batch of images to file"""
+    manifest = context["manifest"]
+    for fn, image, masks in results:
+        segment_fns = save_segments(context["a"], fn, image, masks)
+        if len(segment_fns) > 0:
+            manifest.record(fn, "processed", segment_fns)
+        else:
+            manifest.record(fn, "skipped", reason="No segments left after filtering")
+
+
+def segment_files(context, files, report):
+    """Segment a list of (index, filename) pairs and write the segments to file"""
+    a = context["a"]
+    batch_size = max(1, a.BATCH_SIZE)
+    batches = [
+        files[start : start + batch_size] for start in range(0, len(files), batch_size)
+    ]
+
+    # Read the next batch and write the previous one while the model runs
+    run_pipeline(
+        batches,
+        lambda batch: read_batch(context, batch),
+        lambda batch, data: segment_batch(context, batch, data, report),
+        lambda batch, results: write_batch(context, results),
+    )
+
+
 def main(a):
     """Main function to segment a directory of images"""
 
@@ -102,99 +394,69 @@ def main(a):
     if torch.cuda.is_available():
         print("CUDA is available")
         sam.to(device="cuda")
-    mask_generator = SamAutomaticMaskGenerator(sam, min_mask_region_area=(32 * 32))
+    # Output RLE so full-frame masks are never kept around; we decode just the bounding box of each
+    mask_generator = SamAutomaticMaskGenerator(
+        sam, min_mask_region_area=(32 * 32), output_mode="uncompressed_rle"
+    )
+    # Lets us hand the generator image embeddings that were cached or computed in batches
+    mask_generator.predictor = EmbeddingPredictor(sam)
+    embedding_cache = get_embedding_cache(
+        a.EMBEDDING_CACHE_DIRECTORY, a.EMBEDDING_CACHE_SIZE
+    )
 
+    # Prompt SAM with just the boxes of detected objects instead of a dense grid of points
+    detector = None
+    if a.PROMPT == "detector":
+        # Only the boxes are used, so skip Mask R-CNN's own mask head
+        detector = get_detector(a.DETECTOR_THRESHOLD, with_masks=False)
+    elif a.PROMPT != "auto":
+        print(f"Unknown prompt mode: {a.PROMPT}")
+        return
+
+    # Images are re-processed if any of the parameters that affect the output change
+    params = {
+        "MODEL": a.MODEL,
+        "MAX_SEGMENTS": a.MAX_SEGMENTS,
+        "MAX_IMAGE_DIMENSION": a.MAX_IMAGE_DIMENSION,
+        "TILE_SIZE": a.TILE_SIZE,
+        "TILE_OVERLAP": a.TILE_OVERLAP,
+        "EDGE": a.EDGE,
+        "REMOVE_LARGEST": a.REMOVE_LARGEST,
+        "COMPOSITE": a.COMPOSITE,
+    }
+    # Only add these in detector mode so existing runs with automatic prompts are still current
+    if detector is not None:
+        params["PROMPT"] = a.PROMPT
+        params["DETECTOR_THRESHOLD"] = a.DETECTOR_THRESHOLD
+    manifest = RunManifest(os.path.join(a.OUTPUT_DIR, "manifest.db"), params)
+
+    # Queue up the files that have not been processed yet
+    pending = []
     for i, fn in enumerate(filenames):
         exists_fn = f"{a.OUTPUT_DIR}/{get_basename(fn)}.png"
-        if os.path.isfile(exists_fn):
+        if manifest.is_done(fn, a.RETRY_FAILED, exists_fn, commit=False):
             print(f"Already processed {i+1} of {file_count}: {fn}")
             continue
-        print(f"Processing {i+1} of {file_count}: {fn}")
-
-        image = cv2.imread(fn)
-        im_h, im_w, im_c = image.shape
-        im_d = max(im_h, im_w)
-
-        # Resize if necessary
-        if im_d > a.MAX_IMAGE_DIMENSION:
-            scale = 1.0 * a.MAX_IMAGE_DIMENSION / im_d
-            im_h = round_int(im_h * scale)
-            im_w = round_int(im_w * scale)
-            image = cv2.resize(image, (im_w, im_h))
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        try:
-            masks = mask_generator.generate(image)
-        except RuntimeError as error:
-            print(f"Error with file {fn}; skipping: {error}")
-            continue
-        if len(masks) == 0:
-            continue
-        if a.REMOVE_LARGEST and len(masks) > 1:
-            # remove the mask with the largest bounding box (which should be the background)
-            masks = sorted(
-                masks, key=lambda x: x["bbox"][2] * x["bbox"][3], reverse=True
-            )
-            masks = masks[1:]
-        # sort by area
-        masks = sorted(masks, key=(lambda x: x["area"]), reverse=True)
-
-        # remove masks that are on the edge
-        non_edge_masks = []
-        for mask in masks:
-            edge = max(1, im_h * a.EDGE, im_w * a.EDGE)
-            x, y, w, h = tuple(mask["bbox"])
-            x2 = x + w
-            y2 = y + h
-            if x > edge and y > edge and x2 < (im_w - edge) and y2 < (im_h - edge):
-                non_edge_masks.append(mask)
-        masks = non_edge_masks
-        if len(masks) == 0:
-            continue
+        pending.append((i, fn))
+    manifest.commit()
 
-        # Add transparency
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGRA)
-
-        # If this is a composite
-        if a.COMPOSITE != "" and len(masks) > 1:
-            largest_mask = masks[0]
-            remainder = masks[1:]
-
-            # Merge the largest segment with all segments that are within it's bounding box
-            for mask in remainder:
-                if a.COMPOSITE == "all" or bbox_contains(
-                    tuple(largest_mask["bbox"]), tuple(mask["bbox"])
-                ):
-                    largest_mask["segmentation"] = np.logical_or(
-                        largest_mask["segmentation"], mask["segmentation"]
-                    )
+    # Workers share the model's weights instead of each loading a copy
+    if a.PROCESSES > 1:
+        sam.share_memory()
+        if detector is not None:
+            detector.share_memory()
 
-            masks = [largest_mask]
-
-        else:
-            sample_size = a.MAX_SEGMENTS
-            if len(masks) > sample_size:
-                masks = masks[:sample_size]
-
-        for j, mask in enumerate(masks):
-            basename = f"{get_basename(fn)}-{j+1}" if j > 0 else get_basename(fn)
-            segment_fn = f"{a.OUTPUT_DIR}/{basename}.png"
-            x, y, w, h = tuple(mask["bbox"])
-            if x is None or y is None or w is None or h is None:
-                continue
-            x = int(x)
-            y = int(y)
-            w = int(w)
-            h = int(h)
-            x2 = x + w
-            y2 = y + h
-            segment = mask["segmentation"]
-            # print(mask["bbox"], segment.shape, segment.dtype)
-            # bg = np.zeros(image.shape, image.dtype)
-            segment_mask = segment.astype(np.uint8)
-            segment_mask *= 255
-            masked_image = cv2.bitwise_and(image, image, mask=segment_mask)
-            cropped_image = masked_image[y:y2, x:x2]
-            cv2.imwrite(segment_fn, cropped_image)
+    context = {
+        "a": a,
+        "sam": sam,
+        "mask_generator": mask_generator,
+        "detector": detector,
+        "embedding_cache": embedding_cache,
+        "manifest": manifest,
+        "file_count": file_count,
+    }
+    process_files(pending, segment_files, context, a.PROCESSES)
+    manifest.close()
 
 
 main(parse_args())
@@ -11,8 +11,21 @@ parser.add_argument(
     default="output/met-sculptures/10766.jpg",
     help="Input image file",
 )
+parser.add_argument(
+    "-k",
+    dest="TOP_K",
+    type=int,
+    default=1,
+    help="Number of largest segments to list",
+)
 args = parser.parse_args()
 
-im = cv2.imread(args.INPUT_FILE)
+im = cv2.imread(args.INPUT_FILE, cv2.IMREAD_GRAYSCALE)
+
+# Separate the foreground from the background with Otsu's threshold
+_, mask = cv2.threshold(im, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+for segment in get_largest_mask_segment(mask, top_k=args.TOP_K):
+    print(f"Segment with area {segment['area']} at {segment['bbox']}")
 
-get_largest_segment_bb(im, debug=True)
+get_largest_mask_segment(mask, debug=True)
@@ -1,17 +1,289 @@
 """Utility functions to support all scripts"""
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 import glob
+import hashlib
 import json
+import multiprocessing
 import os
 import pickle
+import queue
+import random
 import re
+import sqlite3
 import struct
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+from urllib.request import pathname2url
 
 import cv2
 import numpy as np
 from PIL import Image
 import piexif
 import requests
+from requests.adapters import HTTPAdapter
+
+# Numpy byte orders of the raw modes 16-bit grayscale TIFF data can be stored in
+RAW_16BIT_DTYPES = {"I;16": "<u2", "I;16L": "<u2", "I;16B": ">u2", "I;16N": "=u2"}
+
+# EXIF tag for how the camera was rotated
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Pillow's decompression bomb limit is turned off while reading image headers; one thread at a time
+IMAGE_HEADER_LOCK = threading.Lock()
+
+# Scales that cv2 can decode JPEGs at directly, largest reduction first
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# Faster JSON decoding and Parquet output are optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Max number of simultaneous requests to any one host
+MAX_REQUESTS_PER_HOST = 4
+HOST_SEMAPHORES = {}
+HOST_SEMAPHORES_LOCK = threading.Lock()
+
+# Shared HTTP session so connections to the same host are reused
+HTTP_POOL_SIZE = 10
+HTTP_MAX_RETRIES = 5
+HTTP_RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+HTTP_RETRY_BASE_DELAY = 1.0
+HTTP_RETRY_MAX_DELAY = 60.0
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+
+class KeyValueCache:
+    """Dict-like cache persisted to a SQLite database so items can be added and committed one at a time"""
+
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        if read_only:
+            # Open an existing database without creating or changing it
+            self.connection = sqlite3.connect(
+                f"file:{pathname2url(os.path.abspath(filename))}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+                timeout=60,
+            )
+            return
+        self.connection = sqlite3.connect(filename, check_same_thread=False, timeout=60)
+        # Write-ahead logging lets other processes read while we write
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)"
+        )
+        self.connection.commit()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+        return row[0]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                (str(key), pickle.dumps(value)),
+            )
+
+    def close(self):
+        """Commit any pending changes and close the database"""
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def commit(self):
+        """Commit pending changes to disk"""
+        with self.lock:
+            self.connection.commit()
+
+    def get(self, key, default_value=None):
+        """Return the value for a key, or a default value if it is not cached"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM cache WHERE key = ?", (str(key),)
+            ).fetchone()
+        return pickle.loads(row[0]) if row is not None else default_value
+
+    def items(self):
+        """Return all the cached (key, value) pairs"""
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM cache").fetchall()
+        return [(key, pickle.loads(value)) for key, value in rows]
+
+    def update(self, data):
+        """Add all the items of a dict to the cache"""
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                [(str(key), pickle.dumps(value)) for key, value in data.items()],
+            )
+
+
+class RunManifest:
+    """Record of the inputs a script has processed, skipped, or failed on, and the parameters it used"""
+
+    def __init__(self, filename, params=None, read_only=False):
+        self.filename = filename
+        self.read_only = read_only
+        self.pid = os.getpid()
+        self.store = None
+        self.entries = {}
+        if read_only:
+            # Read any existing entries without creating or writing anything, e.g. when probing;
+            # entries recorded after this are only kept in memory
+            if os.path.isfile(filename):
+                store = KeyValueCache(filename, read_only=True)
+                self.entries = dict(store.items())
+                store.close()
+        else:
+            # Make sure there is somewhere to write it, e.g. in debug mode where scripts don't create their output directory
+            dirname = os.path.dirname(filename)
+            if dirname != "" and not os.path.isdir(dirname):
+                print(f"Creating {dirname} for the run manifest")
+                os.makedirs(dirname, exist_ok=True)
+            self.store = KeyValueCache(filename)
+            # Load every entry once so lookups don't touch the disk
+            self.entries = dict(self.store.items())
+        params_string = json.dumps(params or {}, sort_keys=True, default=str)
+        self.params_hash = hashlib.sha1(params_string.encode()).hexdigest()
+
+    def __contains__(self, key):
+        return str(key) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        """Close the manifest's database"""
+        if not self.read_only:
+            self.get_store().close()
+
+    def get_store(self):
+        """Return the manifest's database, reopening it if this is a forked process"""
+        # Swap in the new connection before the pid, so no thread that sees the new pid can get the parent's connection
+        pid = os.getpid()
+        if pid != self.pid:
+            self.store = KeyValueCache(self.filename)
+            self.pid = pid
+        return self.store
+
+    def is_done(self, key, retry_failed=False, existing_output=None, commit=True):
+        """Check if an input can be skipped; an existing output with no manifest entry counts as processed"""
+        key = str(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            if existing_output is not None and os.path.isfile(existing_output):
+                self.record(key, "processed", [existing_output], commit=commit)
+                return True
+            return False
+        if entry["params"] != self.params_hash:
+            return False
+        if entry["status"] == "failed":
+            return not retry_failed
+        return True
+
+    def commit(self):
+        """Commit entries recorded with commit=False"""
+        if not self.read_only:
+            self.get_store().commit()
+
+    def is_current(self, key):
+        """Check if an input has an entry from a run with the current parameters"""
+        entry = self.entries.get(str(key))
+        return entry is not None and entry["params"] == self.params_hash
+
+    def record(self, key, status, outputs=None, reason="", commit=True):
+        """Record that an input was processed, skipped, or failed"""
+        key = str(key)
+        entry = {
+            "status": status,
+            "reason": reason,
+            "params": self.params_hash,
+            "outputs": outputs or [],
+        }
+        self.entries[key] = entry
+        if self.read_only:
+            return
+        store = self.get_store()
+        store[key] = entry
+        if commit:
+            store.commit()
+
+    def reload(self):
+        """Reload the entries from disk, e.g. after worker processes recorded their own"""
+        if not self.read_only:
+            self.entries = dict(self.get_store().items())
+
+
+class TableWriter:
+    """Write a table to a CSV or Parquet file one batch of rows at a time"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.temp_filename = f"{filename}.part"
+        self.format = "csv"
+        if os.path.splitext(filename)[1].lower() in [".parquet", ".pq"]:
+            if pa is None:
+                raise ImportError("pyarrow is not installed; run: pip install pyarrow")
+            self.format = "parquet"
+        self.file = None
+        self.parquet_writer = None
+        self.rows = 0
+
+    def close(self):
+        """Finish writing and move the file into place"""
+        if self.file is not None:
+            self.file.close()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        if os.path.isfile(self.temp_filename):
+            os.replace(self.temp_filename, self.filename)
+
+    def write(self, df):
+        """Append a DataFrame; the first one written sets the columns"""
+        if self.format == "parquet":
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.temp_filename, table.schema)
+            else:
+                table = table.cast(self.parquet_writer.schema)
+            # Each batch becomes its own row group
+            self.parquet_writer.write_table(table)
+        else:
+            if self.file is None:
+                self.file = open(self.temp_filename, "w", encoding="utf-8", newline="")
+                df.to_csv(self.file)
+            elif len(df) > 0:
+                df.to_csv(self.file, header=False)
+        self.rows += len(df)
 
 
 def bbox_contains(bbox_a, bbox_b):
@@ -26,6 +298,17 @@ def bbox_contains(bbox_a, bbox_b):
     return b_x1 >= a_x1 and b_x2 <= a_x2 and b_y1 >= a_y1 and b_y2 <= a_y2
 
 
+def configure_http_session(pool_size=10, max_retries=5):
+    """Set the connection pool size and retry count of the shared HTTP session"""
+    global HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        HTTP_POOL_SIZE = max(1, pool_size)
+        HTTP_MAX_RETRIES = max(0, max_retries)
+        if HTTP_SESSION is not None:
+            HTTP_SESSION.close()
+        HTTP_SESSION = None
+
+
 def download(url, filename, overwrite=False, verbose=True):
     """Function for downloading an arbitrary file as binary file."""
     if os.path.isfile(filename) and not overwrite:
@@ -34,12 +317,16 @@ def download(url, filename, overwrite=False, verbose=True):
         return
     if verbose:
         print(f"Downloading file from {url}...")
+    # Write to a temporary file so an interrupted download is never mistaken for a complete one
+    partial_filename = f"{filename}.part"
     try:
-        r = requests.get(url, stream=True, timeout=30)
-        with open(filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
+        with get_host_semaphore(url):
+            r = http_get(url, stream=True, timeout=30)
+            with open(partial_filename, "wb") as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
+        os.replace(partial_filename, filename)
         if verbose:
             print(f"Downloaded {url}")
     except requests.exceptions.MissingSchema:
@@ -48,19 +335,27 @@ def download(url, filename, overwrite=False, verbose=True):
         print(f"HTTP error when trying to get {url}")
     except requests.Timeout:
         print(f"Timeout when trying to get {url}")
+    except requests.ConnectionError:
+        print(f"Connection error when trying to get {url}")
+    finally:
+        if os.path.isfile(partial_filename):
+            os.remove(partial_filename)
 
 
 def download_and_read_image(url):
     """Download and read an image without saving to file"""
     im = False
     try:
-        im = Image.open(requests.get(url, stream=True, timeout=60).raw)
+        with get_host_semaphore(url):
+            im = Image.open(http_get(url, stream=True, timeout=60).raw)
     except requests.HTTPError:
         print(f"HTTP error when trying to get image {url}")
     except requests.exceptions.MissingSchema:
         print(f"Schema error when trying to get image {url}")
     except requests.Timeout:
         print(f"Timeout when trying to get image {url}")
+    except requests.ConnectionError:
+        print(f"Connection error when trying to get image {url}")
     return im
 
 
@@ -71,11 +366,42 @@ def empty_directory(dirname):
     remove_files(files)
 
 
+def extract_segment(image, mask, bbox):
+    """Crop an RGB image to a bounding box and return it as BGRA with the mask in the alpha channel"""
+    x, y, w, h = [int(v) for v in bbox]
+    cropped_image = image[y : y + h, x : x + w]
+
+    # The mask can be full-frame or already cropped to the bounding box
+    if mask.shape[:2] != cropped_image.shape[:2]:
+        mask = mask[y : y + h, x : x + w]
+    alpha = np.ascontiguousarray(mask > 0).view(np.uint8) * np.uint8(255)
+
+    segment = cv2.cvtColor(cropped_image, cv2.COLOR_RGB2BGRA)
+    segment[:, :, 3] = alpha
+    return cv2.bitwise_and(segment, segment, mask=alpha)
+
+
 def get_basename(fn):
     """Function to return the name of the filename without an extension"""
     return os.path.splitext(os.path.basename(fn))[0]
 
 
+def get_content_length(url):
+    """Return the size in bytes of the file at a URL without downloading it, or None if it is unknown"""
+    try:
+        with get_host_semaphore(url):
+            response = http_request("HEAD", url, timeout=30)
+    except (
+        requests.exceptions.MissingSchema,
+        requests.HTTPError,
+        requests.Timeout,
+        requests.ConnectionError,
+    ):
+        return None
+    content_length = response.headers.get("Content-Length")
+    return int(content_length) if content_length is not None else None
+
+
 def get_filenames(file_string, verbose=False):
     """Function for retrieve a list of files given a string."""
     files = []
@@ -92,39 +418,87 @@ def get_filenames(file_string, verbose=False):
     return files
 
 
-def get_largest_mask_segment(mask_image, debug=False):
-    """Function to return the mask and bounding box of the largest segment in the image"""
+def get_image_size(filename):
+    """Return the (width, height, format) of an image as it will be displayed, read from its header without decoding it; None if it can't be read"""
+    # Only the header is read, so Pillow's decompression bomb limit doesn't apply; huge masters are the ones that need a reduced decode most
+    with IMAGE_HEADER_LOCK:
+        max_image_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            with Image.open(filename) as image:
+                im_w, im_h = image.size
+                # cv2 rotates images by their EXIF orientation; 5-8 swap width and height
+                if image.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+                    im_w, im_h = im_h, im_w
+                return im_w, im_h, image.format
+        except (OSError, SyntaxError, ValueError):
+            return None
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_image_pixels
 
-    # Try to get the largest segment
-    nb_components, output, stats, centroids = cv2.connectedComponentsWithStats(
-        mask_image, connectivity=4
-    )
-    sizes = stats[:, -1]
-    max_label = 1
-    max_size = sizes[1]
-    for i in range(1, nb_components):
-        if sizes[i] > max_size:
-            max_label = i
-            max_size = sizes[i]
-    mask_with_largest_segment = np.zeros(output.shape)
-    mask_with_largest_segment[output == max_label] = 255
+
+def get_host_semaphore(url):
+    """Return the semaphore that caps simultaneous requests to a URL's host"""
+    host = urlparse(url).netloc
+    with HOST_SEMAPHORES_LOCK:
+        if host not in HOST_SEMAPHORES:
+            HOST_SEMAPHORES[host] = threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST)
+        return HOST_SEMAPHORES[host]
+
+
+def get_http_session():
+    """Return the shared HTTP session, creating it if necessary"""
+    global HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+            )
+            HTTP_SESSION = requests.Session()
+            HTTP_SESSION.mount("http://", adapter)
+            HTTP_SESSION.mount("https://", adapter)
+        return HTTP_SESSION
+
+
+def get_largest_mask_segment(mask_image, debug=False, top_k=None):
+    """Return the cropped uint8 mask, bounding box, and area of the largest segment in a mask image, or None if it is empty; with top_k, a list of up to that many largest segments"""
+
+    _, output, stats, _ = cv2.connectedComponentsWithStats(mask_image, connectivity=4)
+    # Label 0 is the background
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    if top_k is None:
+        labels = [int(np.argmax(areas)) + 1] if len(areas) > 0 else []
+    else:
+        # Stable sort so ties keep the lowest label, like argmax
+        labels = (np.argsort(-areas, kind="stable")[:top_k] + 1).tolist()
+
+    segments = []
+    for label in labels:
+        x, y, width, height, area = stats[label].tolist()
+        # Only the bounding box of the segment is compared and kept
+        cropped = output[y : y + height, x : x + width] == label
+        mask = cropped.view(np.uint8) * np.uint8(255)
+        segments.append({"mask": mask, "bbox": (x, y, width, height), "area": area})
 
     # Display mask
-    if debug:
+    if debug and len(segments) > 0:
         scale = 0.333
         cv2.imshow(
             "Biggest component",
-            cv2.resize(mask_with_largest_segment, (0, 0), fx=scale, fy=scale),
+            cv2.resize(segments[0]["mask"], (0, 0), fx=scale, fy=scale),
         )
         cv2.waitKey(0)
 
-    # get bounding box
-    width = stats[max_label, cv2.CC_STAT_WIDTH]
-    height = stats[max_label, cv2.CC_STAT_HEIGHT]
-    x = stats[max_label, cv2.CC_STAT_LEFT]
-    y = stats[max_label, cv2.CC_STAT_TOP]
+    if top_k is not None:
+        return segments
+    return segments[0] if len(segments) > 0 else None
+
 
-    return {"mask": mask_with_largest_segment, "bbox": (x, y, width, height)}
+def get_list_item(values, index, default_value=""):
+    """Return an item of a list, or a default value if it is not a list or is too short"""
+    if isinstance(values, list) and len(values) > index:
+        return values[index]
+    return default_value
 
 
 def get_nested_value(root, nodes, default_value=""):
@@ -153,6 +527,74 @@ def get_nested_value(root, nodes, default_value=""):
     return value
 
 
+def get_raw_16bit_tiles(image):
+    """Return the (box, file offset, bytes per row, dtype) of each strip or tile of an uncompressed 16-bit grayscale image file, or None if it is not stored that way"""
+    if image.mode not in ["I;16", "I;16B"] or not image.filename:
+        return None
+
+    tiles = []
+    for tile in image.tile:
+        codec, box, offset, args = tile
+        rawmode = args[0] if isinstance(args, tuple) else args
+        if codec != "raw" or rawmode not in RAW_16BIT_DTYPES:
+            return None
+        x1, y1, x2, y2 = box
+        stride = args[1] if isinstance(args, tuple) and len(args) > 1 else 0
+        row_bytes = stride if stride > 0 else (x2 - x1) * 2
+        tiles.append((box, offset, row_bytes, RAW_16BIT_DTYPES[rawmode]))
+    return tiles if len(tiles) > 0 else None
+
+
+def get_retry_delay(attempt, retry_after=None):
+    """Return seconds to wait before retrying a request, using Retry-After if the server sent one"""
+    if retry_after:
+        try:
+            return min(HTTP_RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            retry_date = parsedate_to_datetime(retry_after)
+            return min(
+                HTTP_RETRY_MAX_DELAY, max(0.0, retry_date.timestamp() - time.time())
+            )
+        except (TypeError, ValueError):
+            pass
+
+    # Exponential backoff with full jitter
+    delay = min(HTTP_RETRY_MAX_DELAY, HTTP_RETRY_BASE_DELAY * (2**attempt))
+    return random.uniform(0, delay)
+
+
+def get_sized_image_url(url, max_dimension, width=None, height=None):
+    """Rewrite an IIIF or ids.si.edu image URL to request no more than max_dimension pixels on its longest side"""
+    if max_dimension <= 0:
+        return url
+
+    # LoC URLs often end with a #h=...&w=... hint of the image's size
+    base_url, _, fragment = url.partition("#")
+    hints = dict(parse_qsl(fragment))
+    if width is None and height is None and "w" in hints and "h" in hints:
+        width = float(hints["w"])
+        height = float(hints["h"])
+    if width is not None and height is not None and max(width, height) <= max_dimension:
+        return url
+
+    # IIIF: {server}/{identifier}/{region}/{size}/{rotation}/{quality}.{format}
+    iiif_match = re.match(r"^(.+/full/)[^/]+(/[^/]+/[^/]+)$", base_url)
+    if iiif_match is not None:
+        size = f"!{max_dimension},{max_dimension}"
+        return f"{iiif_match.group(1)}{size}{iiif_match.group(2)}"
+
+    # Smithsonian's image delivery service takes a max size parameter
+    parts = urlparse(base_url)
+    if parts.netloc == "ids.si.edu" and "deliveryService" in parts.path:
+        params = [(k, v) for k, v in parse_qsl(parts.query) if k != "max"]
+        params.append(("max", str(max_dimension)))
+        return urlunparse(parts._replace(query=urlencode(params, safe=":/")))
+
+    return url
+
+
 def get_where(arr, return_key, condition, default_value=""):
     """Return a value from a list based on a condition"""
     value = default_value
@@ -168,29 +610,109 @@ def get_where(arr, return_key, condition, default_value=""):
     return value
 
 
+def http_get(url, stream=False, timeout=30):
+    """Make a GET request with the shared session, retrying throttled, failed, or dropped requests"""
+    return http_request("GET", url, stream=stream, timeout=timeout)
+
+
+def http_request(method, url, stream=False, timeout=30):
+    """Make a request with the shared session, retrying throttled, failed, or dropped requests"""
+    session = get_http_session()
+    attempt = 0
+    while True:
+        try:
+            response = session.request(
+                method, url, stream=stream, timeout=timeout, allow_redirects=True
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= HTTP_MAX_RETRIES:
+                raise
+            time.sleep(get_retry_delay(attempt))
+            attempt += 1
+            continue
+
+        if (
+            response.status_code not in HTTP_RETRY_STATUS_CODES
+            or attempt >= HTTP_MAX_RETRIES
+        ):
+            response.raise_for_status()
+            return response
+
+        delay = get_retry_delay(attempt, response.headers.get("Retry-After"))
+        response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
 def json_request(url):
     """Make a JSON request"""
     data = {}
     try:
-        response = requests.get(url, timeout=30)
+        with get_host_semaphore(url):
+            response = http_get(url, timeout=30)
         data = response.json()
     except requests.HTTPError:
         data = {"error": "HTTPError"}
     except requests.Timeout:
         data = {"error": "Timeout"}
+    except requests.ConnectionError:
+        data = {"error": "ConnectionError"}
     except requests.JSONDecodeError:
         data = {"error": "JSONDecodeError"}
     return data
 
 
 def load_cache_file(filename, defaultValue={}):
-    """Load a pickle file"""
+    """Load a pickle file, or a SQLite key-value cache if the filename ends with .db"""
+    if filename.endswith(".db"):
+        is_new = not os.path.isfile(filename)
+        cache = KeyValueCache(filename)
+
+        # Import a legacy pickle cache if one exists next to the new one
+        legacy_filename = f"{os.path.splitext(filename)[0]}.p"
+        if is_new and os.path.isfile(legacy_filename):
+            cache.update(pickle.load(open(legacy_filename, "rb")))
+            cache.commit()
+        return cache
+
     if os.path.isfile(filename):
         return pickle.load(open(filename, "rb"))
     else:
         return defaultValue
 
 
+def load_image(filename, max_dimension=0):
+    """Read an image as RGB, resizing it if it is larger than the max dimension; JPEGs are decoded at a reduced scale when they are at least twice as large"""
+    flags = cv2.IMREAD_COLOR
+    size = None
+    if max_dimension > 0:
+        size = get_image_size(filename)
+    if size is not None:
+        im_w, im_h, image_format = size
+        im_d = max(im_h, im_w)
+        # libjpeg can decode at 1/2, 1/4, or 1/8 scale for a fraction of the work and memory
+        if image_format == "JPEG":
+            for reduction, reduced_flag in REDUCED_DECODE_FLAGS:
+                if im_d / reduction >= max_dimension:
+                    flags = reduced_flag
+                    break
+
+    image = cv2.imread(filename, flags)
+    if image is None:
+        return None
+    if size is None:
+        im_h, im_w, _ = image.shape
+    im_d = max(im_h, im_w)
+
+    # Resize if necessary; the target size comes from the full-size dimensions either way
+    if max_dimension > 0 and im_d > max_dimension:
+        scale = 1.0 * max_dimension / im_d
+        im_h = round_int(im_h * scale)
+        im_w = round_int(im_w * scale)
+        image = cv2.resize(image, (im_w, im_h))
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
 def make_directories(filenames):
     """Function for creating directories if they do not exist."""
     if not isinstance(filenames, list):
@@ -201,6 +723,54 @@ def make_directories(filenames):
             os.makedirs(dirname)
 
 
+def parse_si_json(json_data):
+    """Convert a Smithsonian open access JSON data item to flat row"""
+    row = {}
+
+    # Look up each section once instead of walking down from the root for every field
+    content = json_data.get("content", {})
+    descriptive = content.get("descriptiveNonRepeating", {})
+    structured = content.get("indexedStructured", {})
+    freetext = content.get("freetext", {})
+    object_types = structured.get("object_type")
+
+    row["id"] = descriptive.get("record_ID", "")
+    row["title"] = json_data.get("title", "Untitled")
+    row["unit_code"] = json_data.get("unitCode", "")
+    row["record_link"] = descriptive.get("record_link", "")
+    row["access"] = descriptive.get("metadata_usage", {}).get("access", "")
+    row["data_source"] = descriptive.get("data_source", "")
+    row["date"] = get_list_item(structured.get("date"), 0)
+    row["name"] = get_list_item(structured.get("name"), 0)
+    row["object_type"] = get_list_item(object_types, 0)
+    row["object_type_2"] = get_list_item(object_types, 1)
+    row["object_type_3"] = get_list_item(object_types, 2)
+    row["topic"] = get_list_item(structured.get("topic"), 0)
+    row["place"] = get_list_item(structured.get("place"), 0)
+
+    sets = freetext.get("setName", [])
+    row["group"] = sets[-1]["content"] if len(sets) > 0 else ""
+
+    notes = freetext.get("notes", [])
+    row["description"] = get_where(notes, "content", ("label", "Description"))
+
+    physical_descriptions = freetext.get("physicalDescription", [])
+    row["medium"] = get_where(physical_descriptions, "content", ("label", "Medium"))
+    row["dimensions"] = get_where(
+        physical_descriptions, "content", ("label", "Dimensions")
+    )
+
+    media = get_list_item(descriptive.get("online_media", {}).get("media"), 0, {})
+    resources = [r for r in media.get("resources", []) if "height" in r]
+    if len(resources) > 0:
+        largest_resource = max(resources, key=lambda r: r["height"])
+        row["image"] = largest_resource["url"]
+        row["image_width"] = largest_resource["width"]
+        row["image_height"] = largest_resource["height"]
+
+    return row
+
+
 def read_image_meta(image_filename, meta):
     """Read exif metadata from image file"""
     exif_dict = piexif.load(image_filename)
@@ -211,14 +781,19 @@ def read_image_meta(image_filename, meta):
     return values
 
 
-def read_line_delimited_json(filename):
-    """Read a line-delimted json file"""
-    results = []
+def iter_line_delimited_json(filename, offset=0):
+    """Yield the items of a line-delimited json file one at a time, starting at a byte offset"""
+    loads = orjson.loads if orjson is not None else json.loads
     with open(filename, "rb") as f:
+        f.seek(offset)
         for line in f:
-            item = json.loads(line.decode())
-            results.append(item)
-    return results
+            if line.strip():
+                yield loads(line)
+
+
+def read_line_delimited_json(filename):
+    """Read a line-delimted json file"""
+    return list(iter_line_delimited_json(filename))
 
 
 def read_lines(filename):
@@ -247,9 +822,174 @@ def round_int(value):
     return int(round(value))
 
 
+def run_jobs(jobs, job_fn, workers=1, processes=False):
+    """Run a function over a list of jobs in a bounded thread (or forked process) pool, yielding results in job order"""
+    if workers <= 1:
+        for job in jobs:
+            yield job_fn(job)
+        return
+
+    # Workers are forked so job_fn can be any module-level function of the running script;
+    # where fork isn't available (e.g. Windows), fall back to threads
+    if processes and "fork" not in multiprocessing.get_all_start_methods():
+        print("Forked worker processes are not supported here; using threads instead")
+        processes = False
+
+    # Only keep a limited window of jobs in flight so large job lists don't queue up all at once;
+    # process results are pickled back to the parent, so keep just enough to keep every worker busy
+    max_pending = workers + 1 if processes else workers * 4
+    if processes:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    with executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(job_fn, job))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_pipeline(items, read_fn, process_fn, write_fn, queue_size=2, readers=1):
+    """Run items through read, process, and write stages; reading and writing happen in background threads so they overlap with processing"""
+    done = object()
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    stop = threading.Event()
+
+    def read_items():
+        try:
+            for item, data in run_jobs(
+                items, lambda item: (item, read_fn(item)), readers
+            ):
+                if stop.is_set():
+                    break
+                read_queue.put((item, data))
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+        finally:
+            read_queue.put(done)
+
+    def write_items():
+        while True:
+            entry = write_queue.get()
+            if entry is done:
+                break
+            if len(errors) > 0:
+                continue
+            try:
+                write_fn(*entry)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+    reader = threading.Thread(target=read_items, daemon=True)
+    writer = threading.Thread(target=write_items, daemon=True)
+    reader.start()
+    writer.start()
+
+    try:
+        while len(errors) == 0:
+            entry = read_queue.get()
+            if entry is done:
+                break
+            item, data = entry
+            result = process_fn(item, data)
+            write_queue.put((item, result))
+    finally:
+        write_queue.put(done)
+        writer.join()
+
+        # Unblock the reader if processing stopped early
+        stop.set()
+        while reader.is_alive():
+            try:
+                read_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
 def save_cache_file(filename, data):
-    """Save a pickle file"""
-    pickle.dump(data, open(filename, "wb"))
+    """Save a pickle file, or commit pending changes if data is a SQLite key-value cache"""
+    if isinstance(data, KeyValueCache):
+        data.commit()
+        return
+
+    # Write to a temporary file first so the cache is never left half-written
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, "wb") as f:
+        pickle.dump(data, f)
+    os.replace(temp_filename, filename)
+
+
+def save_16bit_image_as_8bit(image, filename, rows_per_chunk=256):
+    """Stretch a 16-bit grayscale image to the full 8-bit range and save it; uncompressed files are read a few rows at a time so memory does not grow with image size"""
+    width, height = image.size
+    tiles = get_raw_16bit_tiles(image)
+
+    def iter_chunks():
+        """Yield (x, y, rows) for chunks of rows of the image"""
+        if tiles is None:
+            # Compressed data can only be decoded all at once
+            yield 0, 0, np.asarray(image)
+            return
+        with open(image.filename, "rb") as f:
+            for (x1, y1, x2, y2), offset, row_bytes, dtype in tiles:
+                row_values = row_bytes // 2
+                for y in range(y1, y2, rows_per_chunk):
+                    row_count = min(rows_per_chunk, y2 - y)
+                    f.seek(offset + (y - y1) * row_bytes)
+                    rows = np.fromfile(f, dtype=dtype, count=row_count * row_values)
+                    yield x1, y, rows.reshape(row_count, row_values)[:, : x2 - x1]
+
+    # First pass: find the range of values
+    min_value = None
+    max_value = None
+    for _, _, rows in iter_chunks():
+        if rows.size == 0:
+            continue
+        rows_min = int(rows.min())
+        rows_max = int(rows.max())
+        min_value = rows_min if min_value is None else min(min_value, rows_min)
+        max_value = rows_max if max_value is None else max(max_value, rows_max)
+    if min_value is None:
+        return False
+    value_range = max_value - min_value
+
+    # Second pass: stretch each chunk into an 8-bit buffer backed by a temporary file instead of memory
+    with tempfile.TemporaryFile() as f:
+        pixels = np.memmap(f, dtype=np.uint8, mode="w+", shape=(height, width))
+        for x, y, rows in iter_chunks():
+            for start in range(0, rows.shape[0], rows_per_chunk):
+                chunk = rows[start : start + rows_per_chunk]
+                if value_range > 0:
+                    chunk = (chunk.astype(np.uint16) - min_value) * 255.0 / value_range
+                else:
+                    chunk = np.zeros(chunk.shape)
+                y1 = y + start
+                pixels[y1 : y1 + chunk.shape[0], x : x + chunk.shape[1]] = chunk.astype(
+                    np.uint8
+                )
+        # The image shares the buffer rather than copying it
+        Image.frombuffer("L", (width, height), pixels, "raw", "L", 0, 1).save(filename)
+        del pixels
+
+    return True
+
+
+def set_max_requests_per_host(value):
+    """Set the max number of simultaneous requests to any one host"""
+    global MAX_REQUESTS_PER_HOST
+    with HOST_SEMAPHORES_LOCK:
+        MAX_REQUESTS_PER_HOST = max(1, value)
+        HOST_SEMAPHORES.clear()
 
 
 def string_to_ascii(string):